@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+'''
+Benchmarks the drupalsites execution paths against a synthetic fleet.
+
+Fake ssh, drush, rsync, git and sudo commands are put first on PATH.
+They sleep and print a configurable amount of output, so the real operation
+classes can be run over hundreds of sites without touching a real host.
+Operations that don't run commands, such as remote_cert, can't be faked
+this way and are skipped. CLI latencies are per site, from the start of
+the run until the site's last step is done, for every engine.
+Each configuration runs in its own child process, so its peak RSS isn't
+hidden by an earlier, bigger run. Results can be saved as a baseline and
+later runs compared with it.
+
+Example:
+  bench_drupalsites.py --sites 100 500 --ops remote_updates local_update_status --save-baseline base.json
+  bench_drupalsites.py --sites 100 500 --ops remote_updates local_update_status --baseline base.json
+'''
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import stat
+import sys
+import tempfile
+import time
+import drupalsites
+
+FAKE_COMMANDS = ['ssh', 'drush', 'rsync', 'sudo']
+
+# Operations that contact hosts in-process rather than through a command
+UNSUPPORTED_OPS = {'remote_cert': 'it does its TLS handshakes in-process, not through a fake command'}
+
+FAKE_COMMAND_SCRIPT = '''#!/bin/sh
+sleep "${DRUPALSITES_BENCH_SLEEP:-0.05}"
+head -c "${DRUPALSITES_BENCH_OUTPUT:-1024}" /dev/zero | tr '\\000' x
+echo
+'''
+
+# Commit checked out in every synthetic site
+BENCH_HEAD = '0' * 40
+
+# ls-remote reports origin at the checked out commit, so local_update_status
+# skips the pull; a pull finds nothing new either
+FAKE_GIT_SCRIPT = '''#!/bin/sh
+sleep "${{DRUPALSITES_BENCH_SLEEP:-0.05}}"
+if [ "$1" = ls-remote ]; then
+	printf '%s\\t%s\\n' {head} "$3"
+else
+	echo "Already up-to-date."
+fi
+'''.format(head=BENCH_HEAD)
+
+DEFAULT_OPS = ['remote_update_db', 'remote_updates', 'local_update_status']
+
+def install_fake_commands(bin_dir):
+	for command in FAKE_COMMANDS + ['git']:
+		path = os.path.join(bin_dir, command)
+		with open(path, 'w') as script:
+			script.write(FAKE_GIT_SCRIPT if command == 'git' else FAKE_COMMAND_SCRIPT)
+		os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+	os.environ['PATH'] = bin_dir + os.pathsep + os.environ['PATH']
+
+def make_sites(count, root_dir):
+	"""count synthetic sites, each with its own empty doc root and git checkout under root_dir"""
+	sites = {}
+	for n in range(count):
+		name = 'bench{:04d}'.format(n)
+		doc_root = os.path.join(root_dir, name, 'htdocs')
+		os.makedirs(os.path.join(doc_root, 'sites', 'default', 'files'))
+		os.makedirs(os.path.join(doc_root, '.git', 'refs', 'heads'))
+		with open(os.path.join(doc_root, '.git', 'HEAD'), 'w') as head_file:
+			head_file.write('ref: refs/heads/master\n')
+		with open(os.path.join(doc_root, '.git', 'refs', 'heads', 'master'), 'w') as ref_file:
+			ref_file.write(BENCH_HEAD + '\n')
+		sites[name] = drupalsites.Site(name, name, doc_root, base_domain='{}.invalid'.format(name))
+	return sites
+
+def percentile(values, fraction):
+	values = sorted(values)
+	if len(values) == 0:
+		return 0.0
+	index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+	return values[index]
+
+def peak_rss_kb():
+	# ru_maxrss is in kilobytes on Linux, and a high-water mark for the whole
+	# process, hence bench_in_child
+	return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+def run_cli(sites, op_name, jobs, engine):
+	# The dag engine reports each step of a composite operation, so latency is
+	# taken per site as the time its last result arrived
+	start_time = time.time()
+	latencies = {}
+	def on_result(result):
+		ok = not result.skipped and result.exit_code == 0
+		previous_ok = latencies.get(result.site_name, (0.0, True))[1]
+		latencies[result.site_name] = (time.time() - start_time, ok and previous_ok)
+	if engine == 'async':
+		drupalsites.run_coroutine(drupalsites.run_site_ops_async(sites.values(), op_name, jobs=jobs, on_result=on_result,
+			refresh=True))
+	elif engine == 'dag':
+		drupalsites.run_coroutine(drupalsites.run_site_ops_dag(sites.values(), op_name, jobs=jobs, on_result=on_result,
+			refresh=True))
+	else:
+		drupalsites.run_site_ops(sites.values(), op_name, jobs=jobs, on_result=on_result, refresh=True)
+	return list(latencies.values())
+
+def run_web(sites, op_name, jobs, engine):
+	import web_drupalsites
+	web_drupalsites.app.config['JOB_WORKERS'] = jobs
+	web_drupalsites.job_executor = None
+	client = web_drupalsites.app.test_client()
+	job_ids = []
+	for site_name in sites:
+		response = client.post('/jobs', json={'site': site_name, 'op': op_name, 'refresh': True})
+		job_ids.append(response.get_json()['id'])
+	latencies = []
+	for job_id in job_ids:
+		# Reading the stream to the end waits for the job
+		client.get('/jobs/{}/stream'.format(job_id)).get_data()
+		status = client.get('/jobs/{}'.format(job_id)).get_json()
+		latencies.append((status['duration'], status['state'] == 'done'))
+	return latencies
+
+def run_qt(sites, op_name, jobs, engine):
+	import sites_ui
+	worker = sites_ui.SitesOpWorker(jobs)
+	# Called directly, perform() runs the sites on the worker's pool and returns when all are done
+	worker.perform(sorted(sites), op_name, False, False, True)
+	worker.output.take()
+	return [(end_time - start_time, state == 'done') for (site_name, (state, start_time, end_time)) in worker.site_statuses()]
+
+PATHS = {'cli': run_cli, 'web': run_web, 'qt': run_qt}
+
+def path_available(path):
+	try:
+		if path == 'web':
+			import web_drupalsites
+		elif path == 'qt':
+			import sites_ui
+	except ImportError as e:
+		print("Skipping the {} path: {}".format(path, e))
+		return False
+	return True
+
+def bench(path, site_count, op_name, jobs, engine, root_dir):
+	site_dir = tempfile.mkdtemp(dir=root_dir)
+	sites = make_sites(site_count, site_dir)
+	# The web and Qt paths look sites up by name
+	drupalsites.sites.clear()
+	drupalsites.sites.update(sites)
+	drupalsites.metrics.clear()
+	start_time = time.time()
+	latencies = PATHS[path](sites, op_name, jobs, engine)
+	wall = time.time() - start_time
+	shutil.rmtree(site_dir, ignore_errors=True)
+	durations = [duration for (duration, ok) in latencies]
+	self_rss, children_rss = peak_rss_kb()
+	return {'path': path, 'engine': engine if path == 'cli' else '-', 'sites': site_count, 'op': op_name,
+		'jobs': jobs, 'wall': wall, 'throughput': site_count / wall if wall > 0 else 0.0,
+		'p50': percentile(durations, 0.5), 'p95': percentile(durations, 0.95),
+		'failed': len([ok for (duration, ok) in latencies if not ok]),
+		'peak_rss_kb': self_rss, 'peak_child_rss_kb': children_rss}
+
+def bench_in_child(*args):
+	"""bench() in a forked child process, so that the peak RSS is that run's alone"""
+	with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('fork')) as executor:
+		return executor.submit(bench, *args).result()
+
+def result_key(result):
+	return '{path}/{engine}/{op}/{sites}/{jobs}'.format(**result)
+
+def write_report(results, baseline):
+	line_format = "{:<36} {:>8} {:>9} {:>8} {:>8} {:>6} {:>9} {:>10}\n"
+	sys.stdout.write(line_format.format('Run', 'Wall s', 'Sites/s', 'p50 s', 'p95 s', 'Failed', 'RSS MB', 'vs base'))
+	for result in results:
+		compare = ''
+		base = baseline.get(result_key(result))
+		if base is not None and base['throughput'] > 0:
+			compare = '{:+.1f}%'.format(100.0 * (result['throughput'] - base['throughput']) / base['throughput'])
+		sys.stdout.write(line_format.format(result_key(result), '{:.2f}'.format(result['wall']),
+			'{:.1f}'.format(result['throughput']), '{:.3f}'.format(result['p50']), '{:.3f}'.format(result['p95']),
+			result['failed'], '{:.1f}'.format(result['peak_rss_kb'] / 1024.0), compare))
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Benchmark drupalsites against a synthetic fleet',
+		epilog=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--sites', type=int, nargs='+', default=[100, 500, 1000], help='Fleet sizes to run')
+	parser.add_argument('--ops', nargs='+', default=DEFAULT_OPS, help='Operations to run')
+	parser.add_argument('--paths', nargs='+', choices=sorted(PATHS), default=['cli'], help='Execution paths to run')
+	parser.add_argument('--engines', nargs='+', choices=['thread', 'async', 'dag'], default=['thread', 'async'],
+		help='CLI executors to run')
+	parser.add_argument('-j', '--jobs', type=int, default=16)
+	parser.add_argument('--sleep', type=float, default=0.05, help='Seconds each fake command takes')
+	parser.add_argument('--output-bytes', type=int, default=1024, help='Bytes of output from each fake command')
+	parser.add_argument('--baseline', help='Compare with results saved by --save-baseline')
+	parser.add_argument('--save-baseline', help='Save the results to this file')
+	args = parser.parse_args()
+	root_dir = tempfile.mkdtemp(prefix='drupalsites-bench-')
+	try:
+		bin_dir = os.path.join(root_dir, 'bin')
+		os.mkdir(bin_dir)
+		install_fake_commands(bin_dir)
+		os.environ['DRUPALSITES_BENCH_SLEEP'] = str(args.sleep)
+		os.environ['DRUPALSITES_BENCH_OUTPUT'] = str(args.output_bytes)
+		# Keep the benchmark's cached results and ssh sockets out of the real ones
+		drupalsites.result_cache = drupalsites.ResultCache(os.path.join(root_dir, 'cache'))
+		drupalsites.history = drupalsites.RunHistory(os.path.join(root_dir, 'history.sqlite'))
+		drupalsites.fact_cache = drupalsites.FactCache(os.path.join(root_dir, 'facts'))
+		drupalsites.update_state_cache = drupalsites.FactCache(os.path.join(root_dir, 'update-status'))
+		drupalsites.release_cache = drupalsites.ReleaseCache(os.path.join(root_dir, 'releases'))
+		drupalsites.ssh_pool.enabled = False
+		drupalsites.set_operation_output(drupalsites.BufferedOperationOutput())
+		ops = []
+		for op_name in args.ops:
+			if op_name in UNSUPPORTED_OPS:
+				print("Skipping {}: {}".format(op_name, UNSUPPORTED_OPS[op_name]))
+			else:
+				ops.append(op_name)
+		results = []
+		for path in args.paths:
+			if not path_available(path):
+				continue
+			engines = args.engines if path == 'cli' else ['-']
+			for engine in engines:
+				for op_name in ops:
+					for site_count in args.sites:
+						results.append(bench_in_child(path, site_count, op_name, args.jobs, engine, root_dir))
+		baseline = {}
+		if args.baseline is not None:
+			with open(args.baseline) as baseline_file:
+				baseline = dict((result_key(result), result) for result in json.load(baseline_file))
+		write_report(results, baseline)
+		if args.save_baseline is not None:
+			with open(args.save_baseline, 'w') as baseline_file:
+				json.dump(results, baseline_file, indent=2)
+	finally:
+		shutil.rmtree(root_dir, ignore_errors=True)
@@ -1,361 +1,2145 @@
 #!/home/mgering/.virtualenvs/sitesui/bin/python
 # Author: Mike Gering
 
-import abc
 import argparse
+import ast
+import asyncio
+import atexit
+import codecs
+import collections
+import collections.abc
+import concurrent.futures
+import contextvars
+import functools
+import fcntl
+import grp
+import hashlib
+import http.client
+import importlib
+import importlib.metadata
+import importlib.util
+import inspect
+import json
 import os.path
+import pwd
+import random
+import re
 import shlex
+import shutil
+import signal
+import sqlite3
+import ssl
+import stat
 import subprocess
 import sys
+import tempfile
 import textwrap
-import re
+import threading
+import time
+import traceback
+import uuid
+import zlib
+import urllib.request
 import datetime
 
+config = None
+
+def get_config():
+	"""Settings from config.yaml next to this module, or {} if it can't be read"""
+	global config
+	if config is None:
+		try:
+			import yaml
+			with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.yaml')) as config_file:
+				config = yaml.safe_load(config_file) or {}
+		except (ImportError, OSError):
+			config = {}
+	return config
+
 def set_verbose(val):
+	"""Set the process-wide default verbosity"""
 	global verbose
 	verbose = val
 	
 def get_verbose():
 	global verbose
+	context_verbose = _context_verbose.get()
+	if context_verbose is not None:
+		return context_verbose
 	return verbose
 
+output_streaming = False
+output_tail_size = 64 * 1024
+output_spill_dir = None
+
+def set_output_streaming(enabled, tail_size=64 * 1024, spill_dir=None):
+	"""Stream command output as it arrives instead of after the command ends
+	
+	enabled is the default for operations that aren't given streaming.
+	Only the last tail_size bytes of each command's output are kept in
+	cmd_outputs; the full output is written to a file in spill_dir. Files
+	in the system temp directory, the default, are deleted when the
+	operation ends; files in a spill_dir you name are kept for you to read.
+	"""
+	global output_streaming, output_tail_size, output_spill_dir
+	output_streaming = enabled
+	output_tail_size = tail_size
+	output_spill_dir = spill_dir
+
+remote_batching = False
+
+def set_remote_batching(enabled):
+	"""Run each operation's remote steps as one script over a single ssh session"""
+	global remote_batching
+	remote_batching = enabled
+
+# None means use the TIMEOUTS section of config.yaml
+default_op_timeout = None
+default_cmd_timeout = None
+
+def set_timeouts(operation=None, command=None):
+	"""Default seconds allowed for a whole operation and for each command it runs"""
+	global default_op_timeout, default_cmd_timeout
+	default_op_timeout = operation
+	default_cmd_timeout = command
+
+def get_timeouts():
+	timeouts_config = get_config().get('TIMEOUTS') or {}
+	return (default_op_timeout if default_op_timeout is not None else timeouts_config.get('OPERATION'),
+		default_cmd_timeout if default_cmd_timeout is not None else timeouts_config.get('COMMAND'))
+
 def set_operation_output(obj):
 	global op_output
 	op_output = obj
 
 op_output = None
 
+# Output sink and verbosity for the current thread or asyncio task. Operations
+# carry their own output and verbosity; these are the defaults they pick up
+# when they are created without one.
+_context_op_output = contextvars.ContextVar('op_output', default=None)
+_context_verbose = contextvars.ContextVar('verbose', default=None)
+
+def set_thread_operation_output(obj):
+	_context_op_output.set(obj)
+
+def set_thread_verbose(val):
+	_context_verbose.set(val)
+
 def get_operation_output():
 	global op_output
+	context_output = _context_op_output.get()
+	if context_output is not None:
+		return context_output
 	if op_output is None:
 		op_output = OperationOutput()
 	return op_output
 
-def init_sites():
-	# Site init: name, ssh_alias, doc_root, vps_dir = 'www', bam_files = 'sites/default/files/private/backup_migrate', base_domain = ''
-	sites = {}
-	sites['gattishouse'] = Site('gattishouse', 'gh', '/var/www/dev.gattishouse.com/htdocs', base_domain='gattishouse.com')
-	sites['lnba'] = Site('lnba', 'lnba', '/var/www/dev.lnba.net/htdocs', base_domain='lnba.net')
-	sites['unrba'] = Site('unrba', 'unrba', '/var/www/dev.unrba.org/htdocs', base_domain='unrba.org')
-	#sites['ypdrba'] = Site('ypdrba', 'ypdrba', '/var/www/dev.ypdrba.org/htdocs', base_domain="yadkinpeedee.org")
-	sites['ferree-gering'] = Site('ferree-gering', 'fg', '/var/www/dev.ferree-gering.com/htdocs', base_domain='ferree-gering.com')
-	return sites
+def default_inventory_path():
+	if os.environ.get('DRUPALSITES_INVENTORY'):
+		return os.environ['DRUPALSITES_INVENTORY']
+	if get_config().get('INVENTORY'):
+		return get_config()['INVENTORY']
+	return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sites.yaml')
+
+def init_sites(path=None):
+	"""The site inventory; it isn't read until a site is first looked up"""
+	return SiteInventory(path)
+
+class SSHConnectionPool(object):
+	"""One multiplexed ssh master connection per ssh alias
+	
+	Commands to the same alias share the master's TCP connection and
+	authentication through ControlPath, so only the first one pays for the
+	handshake. ssh closes a master once it has had no clients for
+	idle_timeout seconds (ControlPersist); close_all tears down the rest.
+	"""
+	
+	def __init__(self, control_dir=None, idle_timeout=300):
+		self.enabled = True
+		self.control_dir = control_dir
+		self.idle_timeout = idle_timeout
+		self.last_used = {}
+		self.lock = threading.Lock()
+		self.created_control_dir = False
+	
+	def control_path(self):
+		with self.lock:
+			if self.control_dir is None:
+				self.control_dir = tempfile.mkdtemp(prefix='drupalsites-ssh-')
+				self.created_control_dir = True
+		# %C is a hash of the connection, which keeps the socket path short
+		return os.path.join(self.control_dir, '%C')
+	
+	def ssh_options(self, ssh_alias):
+		"""ssh arguments that route a connection to ssh_alias through its master"""
+		if not self.enabled:
+			return []
+		control_path = self.control_path()
+		self.evict_idle()
+		with self.lock:
+			self.last_used[ssh_alias] = time.time()
+		return ['-o', 'ControlMaster=auto', '-o', 'ControlPath={}'.format(control_path),
+			'-o', 'ControlPersist={}'.format(self.idle_timeout)]
+	
+	def rsync_shell(self, ssh_alias):
+		"""Value for rsync's -e option"""
+		return ' '.join(['ssh'] + self.ssh_options(ssh_alias))
+	
+	def evict_idle(self):
+		# ssh has already shut these masters down because of ControlPersist
+		now = time.time()
+		with self.lock:
+			for ssh_alias, last_used in list(self.last_used.items()):
+				if now - last_used > self.idle_timeout:
+					del self.last_used[ssh_alias]
+	
+	def close(self, ssh_alias):
+		with self.lock:
+			self.last_used.pop(ssh_alias, None)
+		subprocess.run(['ssh', '-o', 'ControlPath={}'.format(self.control_path()), '-O', 'exit', ssh_alias],
+			stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+	
+	def close_all(self):
+		with self.lock:
+			ssh_aliases = list(self.last_used.keys())
+		for ssh_alias in ssh_aliases:
+			self.close(ssh_alias)
+		if self.created_control_dir:
+			try:
+				os.rmdir(self.control_dir)
+			except OSError:
+				pass
+
+ssh_pool = SSHConnectionPool()
+atexit.register(ssh_pool.close_all)
+
+def git_branch_ref(repo_dir):
+	"""The ref checked out in repo_dir, such as refs/heads/master, or None if HEAD is detached"""
+	try:
+		with open(os.path.join(repo_dir, '.git', 'HEAD')) as head_file:
+			head = head_file.read().strip()
+	except OSError:
+		return None
+	return head[len('ref: '):] if head.startswith('ref: ') else None
+
+def git_head(repo_dir):
+	"""Commit id checked out in repo_dir, read from .git without running git"""
+	git_dir = os.path.join(repo_dir, '.git')
+	try:
+		with open(os.path.join(git_dir, 'HEAD')) as head_file:
+			head = head_file.read().strip()
+	except OSError:
+		return None
+	if not head.startswith('ref: '):
+		return head
+	ref = head[len('ref: '):]
+	try:
+		with open(os.path.join(git_dir, ref)) as ref_file:
+			return ref_file.read().strip()
+	except OSError:
+		pass
+	try:
+		with open(os.path.join(git_dir, 'packed-refs')) as packed_refs:
+			for line in packed_refs:
+				parts = line.split()
+				if len(parts) == 2 and parts[1] == ref:
+					return parts[0]
+	except OSError:
+		pass
+	return None
+
+def age_str(seconds):
+	if seconds < 90:
+		return "{:.0f} seconds".format(seconds)
+	if seconds < 90 * 60:
+		return "{:.0f} minutes".format(seconds / 60)
+	if seconds < 36 * 3600:
+		return "{:.1f} hours".format(seconds / 3600)
+	return "{:.1f} days".format(seconds / 86400)
+
+def write_json_file(cache_dir, path, entry):
+	"""Atomically write a cache entry; returns False if it couldn't be written
+	
+	A cache that can't be written, such as on a full or read-only disk, just
+	misses next time instead of failing the operation that produced the entry.
+	"""
+	temp_name = None
+	try:
+		os.makedirs(cache_dir, exist_ok=True)
+		with tempfile.NamedTemporaryFile('w', dir=cache_dir, delete=False) as cache_file:
+			temp_name = cache_file.name
+			json.dump(entry, cache_file)
+		os.replace(temp_name, path)
+	except OSError:
+		if temp_name is not None:
+			try:
+				os.remove(temp_name)
+			except OSError:
+				pass
+		return False
+	return True
+
+class ResultCache(object):
+	"""Operation results kept on disk, one JSON file per site and operation
+	
+	An entry is used only while it is younger than the operation's cache_ttl
+	and, if the operation has a cache validator (such as the git HEAD), only
+	while the validator still matches.
+	"""
+	
+	def __init__(self, cache_dir=None):
+		if cache_dir is None:
+			cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'drupalsites', 'results')
+		self.cache_dir = cache_dir
+	
+	def path(self, site_name, op_name):
+		return os.path.join(self.cache_dir, '{}--{}.json'.format(site_name, op_name))
+	
+	def get(self, site_name, op_name, ttl, validator=None):
+		try:
+			with open(self.path(site_name, op_name)) as cache_file:
+				entry = json.load(cache_file)
+		except (OSError, ValueError):
+			return None
+		if time.time() - entry['time'] > ttl or entry.get('validator') != validator:
+			return None
+		return entry
+	
+	def put(self, site_name, op_name, output, exit_code, validator=None):
+		entry = {'time': time.time(), 'output': output, 'exit_code': exit_code, 'validator': validator}
+		# Write then rename so that readers never see a partial file
+		write_json_file(self.cache_dir, self.path(site_name, op_name), entry)
+	
+	def invalidate(self, site_name, op_name):
+		try:
+			os.remove(self.path(site_name, op_name))
+		except OSError:
+			pass
+
+result_cache = ResultCache()
+
+class FactCache(object):
+	"""Facts about each site, such as those from gather_facts, one JSON file per site"""
+	
+	def __init__(self, cache_dir=None):
+		if cache_dir is None:
+			cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'drupalsites', 'facts')
+		self.cache_dir = cache_dir
+	
+	def path(self, site_name):
+		return os.path.join(self.cache_dir, '{}.json'.format(site_name))
+	
+	def get(self, site_name, max_age=None):
+		"""{'time': ..., 'facts': {...}} for the site, or None if there isn't one or it is older than max_age"""
+		try:
+			with open(self.path(site_name)) as cache_file:
+				entry = json.load(cache_file)
+		except (OSError, ValueError):
+			return None
+		if max_age is not None and time.time() - entry['time'] > max_age:
+			return None
+		return entry
+	
+	def put(self, site_name, facts):
+		entry = {'time': time.time(), 'facts': facts}
+		write_json_file(self.cache_dir, self.path(site_name), entry)
+	
+	def invalidate(self, site_name):
+		try:
+			os.remove(self.path(site_name))
+		except OSError:
+			pass
+
+fact_cache = FactCache()
+# What local_update_status last saw upstream, and what drush ups said then
+update_state_cache = FactCache(os.path.join(os.path.expanduser('~'), '.cache', 'drupalsites', 'update-status'))
+
+class ReleaseCache(object):
+	"""Module and core release archives shared by every site's updates
+	
+	Archives are stored once under their SHA-256 and indexed by project and
+	version. When the total size passes max_bytes, the least recently used
+	archives are removed. A file lock keeps processes sharing the cache
+	consistent, and an archive that several sites need at once is only
+	downloaded once.
+	"""
+	
+	url_format = 'https://ftp.drupal.org/files/projects/{project}-{version}.tar.gz'
+	
+	def __init__(self, cache_dir=None, max_bytes=None):
+		release_config = get_config().get('RELEASE_CACHE') or {}
+		if cache_dir is None:
+			cache_dir = release_config.get('DIR') or os.path.join(os.path.expanduser('~'), '.cache', 'drupalsites', 'releases')
+		if max_bytes is None:
+			max_bytes = release_config.get('MAX_MB', 2048) * 1024 * 1024
+		self.cache_dir = cache_dir
+		self.max_bytes = max_bytes
+		self.drush_cache_dir = release_config.get('DRUSH_CACHE_DIR') or os.path.join(os.path.expanduser('~'), '.drush', 'cache', 'download')
+		self.lock = threading.Lock()
+		self.key_locks = {}
+		# Operations using each file seeded into drush's cache
+		self.seeded = collections.Counter()
+	
+	def index_path(self):
+		return os.path.join(self.cache_dir, 'index.json')
+	
+	def object_path(self, digest):
+		return os.path.join(self.cache_dir, 'objects', digest)
+	
+	def locked_index(self, update):
+		"""Call update(index) with the index locked against other processes, saving it afterwards"""
+		os.makedirs(os.path.join(self.cache_dir, 'objects'), exist_ok=True)
+		with self.lock, open(os.path.join(self.cache_dir, 'index.lock'), 'w') as lock_file:
+			fcntl.flock(lock_file, fcntl.LOCK_EX)
+			try:
+				with open(self.index_path()) as index_file:
+					index = json.load(index_file)
+			except (OSError, ValueError):
+				index = {}
+			result = update(index)
+			with tempfile.NamedTemporaryFile('w', dir=self.cache_dir, delete=False) as index_file:
+				json.dump(index, index_file)
+			os.replace(index_file.name, self.index_path())
+			return result
+	
+	def release_url(self, project, version):
+		return self.url_format.format(project=project, version=version)
+	
+	def get(self, project, version):
+		"""Path of the cached archive, or None"""
+		key = '{}-{}'.format(project, version)
+		def touch(index):
+			entry = index.get(key)
+			if entry is None or not os.path.exists(self.object_path(entry['sha256'])):
+				index.pop(key, None)
+				return None
+			entry['last_used'] = time.time()
+			return self.object_path(entry['sha256'])
+		return self.locked_index(touch)
+	
+	def put(self, project, version, url, path):
+		"""Move a downloaded archive into the cache; returns its cached path"""
+		digest = hashlib.sha256()
+		with open(path, 'rb') as archive:
+			for chunk in iter(lambda: archive.read(1024 * 1024), b''):
+				digest.update(chunk)
+		digest = digest.hexdigest()
+		size = os.path.getsize(path)
+		def add(index):
+			if os.path.exists(self.object_path(digest)):
+				os.remove(path)
+			else:
+				os.replace(path, self.object_path(digest))
+			index['{}-{}'.format(project, version)] = {'sha256': digest, 'size': size, 'url': url, 'last_used': time.time()}
+			self.evict(index)
+		self.locked_index(add)
+		return self.object_path(digest)
+	
+	def evict(self, index):
+		sizes = {}
+		for entry in index.values():
+			sizes[entry['sha256']] = entry['size']
+		total = sum(sizes.values())
+		for (key, entry) in sorted(index.items(), key=lambda item: item[1]['last_used']):
+			if total <= self.max_bytes:
+				break
+			del index[key]
+			# Left behind if an update was interrupted before unseeding it
+			drush_path = self.drush_cache_path(entry['url'])
+			if self.seeded[drush_path] == 0:
+				try:
+					os.remove(drush_path)
+				except OSError:
+					pass
+			if not any(other['sha256'] == entry['sha256'] for other in index.values()):
+				total -= entry['size']
+				try:
+					os.remove(self.object_path(entry['sha256']))
+				except OSError:
+					pass
+	
+	def fetch(self, project, version):
+		"""Path of the release archive, downloading it if it isn't cached"""
+		key = '{}-{}'.format(project, version)
+		with self.lock:
+			key_lock = self.key_locks.setdefault(key, threading.Lock())
+		with key_lock:
+			path = self.get(project, version)
+			if path is not None:
+				return (path, False)
+			url = self.release_url(project, version)
+			download_name = None
+			try:
+				with urllib.request.urlopen(url, timeout=60) as response:
+					with tempfile.NamedTemporaryFile('wb', dir=self.cache_dir, delete=False) as download:
+						download_name = download.name
+						for chunk in iter(lambda: response.read(1024 * 1024), b''):
+							download.write(chunk)
+					# read(amt) returns what arrived instead of raising when the connection drops early
+					if response.length:
+						raise http.client.IncompleteRead(b'', response.length)
+				return (self.put(project, version, url, download_name), True)
+			except (OSError, ValueError, http.client.HTTPException):
+				# Don't leave partial downloads in the cache directory
+				if download_name is not None:
+					try:
+						os.remove(download_name)
+					except OSError:
+						pass
+				raise
+	
+	def drush_cache_path(self, url):
+		"""Where drush --cache looks for the download of url"""
+		cached_name = url
+		for char in ':/?=\\':
+			cached_name = cached_name.replace(char, '-')
+		return os.path.join(self.drush_cache_dir, cached_name)
+	
+	def seed_drush_cache(self, project, version, path):
+		"""Put an archive where drush --cache looks for it; returns the path to pass to unseed_drush_cache
+		
+		Seeded files are only there while drush needs them, so that the archives
+		aren't kept twice when they can't be hard linked.
+		"""
+		target = self.drush_cache_path(self.release_url(project, version))
+		with self.lock:
+			self.seeded[target] += 1
+			if self.seeded[target] > 1:
+				return target
+		try:
+			os.makedirs(self.drush_cache_dir, exist_ok=True)
+			if os.path.exists(target):
+				os.remove(target)
+			try:
+				os.link(path, target)
+			except OSError:
+				shutil.copyfile(path, target)
+		except BaseException:
+			self.unseed_drush_cache(target)
+			raise
+		return target
+	
+	def unseed_drush_cache(self, target):
+		with self.lock:
+			self.seeded[target] -= 1
+			if self.seeded[target] > 0:
+				return
+			del self.seeded[target]
+			try:
+				os.remove(target)
+			except OSError:
+				pass
+
+release_cache = ReleaseCache()
+
+def size_str(num_bytes):
+	for unit in ('bytes', 'KB', 'MB', 'GB'):
+		if num_bytes < 1024 or unit == 'GB':
+			return "{:.0f} {}".format(num_bytes, unit) if unit == 'bytes' else "{:.1f} {}".format(num_bytes, unit)
+		num_bytes /= 1024.0
+
+def fact_summary(entry):
+	"""One line about a fact cache entry, for help and the UIs"""
+	if entry is None:
+		return 'no facts, run gather_facts'
+	facts = entry['facts']
+	parts = []
+	if facts.get('core_version') is not None:
+		parts.append('core {}'.format(facts['core_version']))
+	if facts.get('pending_updates') is not None:
+		parts.append('{} updates'.format(len(facts['pending_updates'])))
+	if facts.get('disk_bytes') is not None:
+		parts.append('{} disk'.format(size_str(facts['disk_bytes'])))
+	if facts.get('db_bytes') is not None:
+		parts.append('{} db'.format(size_str(facts['db_bytes'])))
+	parts.append('as of {} ago'.format(age_str(time.time() - entry['time'])))
+	return ', '.join(parts)
+
+class MetricsRegistry(object):
+	"""Timing and I/O records for every command and operation
+	
+	Records are dicts tagged with the site and operation. When a path is set
+	they are appended to a JSONL file. They are only kept in memory, for
+	profile(), when keep is set, so that long-running servers don't grow.
+	"""
+	
+	def __init__(self, path=None, keep=False):
+		self.path = path
+		self.keep = keep
+		self.records = []
+		self.lock = threading.Lock()
+	
+	def record(self, kind, site_name, op_name, start_time, wall, exit_code, **fields):
+		record = {'kind': kind, 'site': site_name, 'op': op_name, 'start': start_time,
+			'wall': wall, 'exit_code': exit_code}
+		record.update(fields)
+		with self.lock:
+			if self.keep:
+				self.records.append(record)
+			if self.path is not None:
+				with open(self.path, 'a') as metrics_file:
+					metrics_file.write(json.dumps(record)+'\n')
+		return record
+	
+	def clear(self):
+		with self.lock:
+			self.records = []
+	
+	def profile(self):
+		"""Per-site, per-step breakdown of where the time went"""
+		with self.lock:
+			records = list(self.records)
+		steps = collections.OrderedDict()
+		for record in sorted(records, key=lambda record: (record['site'] or '', record['start'])):
+			key = (record['site'] or '', record['op'] or '')
+			step = steps.setdefault(key, {'wall': 0.0, 'cmds': 0, 'ssh': 0.0, 'local': 0.0, 'bytes': 0, 'failed': 0})
+			if record['kind'] == 'op':
+				step['wall'] += record['wall']
+				if record['exit_code'] != 0:
+					step['failed'] += 1
+			else:
+				step['cmds'] += 1
+				step['ssh' if record['remote'] else 'local'] += record['wall']
+				step['bytes'] += record['output_bytes']
+		if len(steps) == 0:
+			return "No operations were run\n"
+		max_site_len = max([len('Site')] + [len(site_name) for (site_name, op_name) in steps])
+		max_op_len = max([len('Step')] + [len(op_name) for (site_name, op_name) in steps])
+		line_format = "{}  {}  {:>8}  {:>4}  {:>8}  {:>8}  {:>10}  {:>6}\n"
+		profile = line_format.format('Site'.ljust(max_site_len), 'Step'.ljust(max_op_len), 'Seconds', 'Cmds',
+			'ssh s', 'local s', 'Output', 'Failed')
+		site_totals = collections.OrderedDict()
+		for (site_name, op_name), step in steps.items():
+			profile += line_format.format(site_name.ljust(max_site_len), op_name.ljust(max_op_len),
+				'{:.2f}'.format(step['wall']), step['cmds'], '{:.2f}'.format(step['ssh']),
+				'{:.2f}'.format(step['local']), step['bytes'], step['failed'])
+			site_total = site_totals.setdefault(site_name, [0.0, 0.0])
+			site_total[0] += step['ssh']
+			site_total[1] += step['local']
+		profile += "\nCommand time by site (ssh / local seconds):\n"
+		for site_name, (ssh_time, local_time) in sorted(site_totals.items(), key=lambda item: -sum(item[1])):
+			profile += "  {}  {:>8.2f} / {:.2f}\n".format(site_name.ljust(max_site_len), ssh_time, local_time)
+		return profile
+
+metrics = MetricsRegistry()
+
+def kill_process_group(process):
+	try:
+		os.killpg(process.pid, signal.SIGKILL)
+	except (ProcessLookupError, PermissionError):
+		pass
+
+class OperationControl(object):
+	"""Deadline and cancellation shared by an operation and its sub-operations
+	
+	Commands are started in their own process group and registered here, so
+	cancel() can kill everything that is running, ssh and drush children
+	included, from any thread.
+	"""
+	
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.processes = set()
+		self.cancelled = False
+		self.started = False
+		self.deadline = None
+		# Hosts whose slot this operation tree holds, so nested operations don't wait for it again
+		self.held_hosts = set()
+		# Called by cancel(), e.g. to stop waiting for a host slot
+		self.cancel_callbacks = []
+	
+	def start(self, timeout):
+		# Only the outermost operation's timeout counts
+		if not self.started:
+			self.started = True
+			if timeout is not None:
+				self.deadline = time.time() + timeout
+	
+	def remaining(self):
+		if self.deadline is None:
+			return None
+		return self.deadline - time.time()
+	
+	def expired(self):
+		return self.deadline is not None and time.time() >= self.deadline
+	
+	def add(self, process):
+		with self.lock:
+			self.processes.add(process)
+			cancelled = self.cancelled
+		if cancelled:
+			kill_process_group(process)
+	
+	def discard(self, process):
+		with self.lock:
+			self.processes.discard(process)
+	
+	def add_cancel_callback(self, callback):
+		with self.lock:
+			cancelled = self.cancelled
+			if not cancelled:
+				self.cancel_callbacks.append(callback)
+		if cancelled:
+			callback()
+	
+	def remove_cancel_callback(self, callback):
+		with self.lock:
+			if callback in self.cancel_callbacks:
+				self.cancel_callbacks.remove(callback)
+	
+	def cancel(self):
+		with self.lock:
+			self.cancelled = True
+			processes = list(self.processes)
+			callbacks, self.cancel_callbacks = self.cancel_callbacks, []
+		for process in processes:
+			kill_process_group(process)
+		for callback in callbacks:
+			callback()
+
+class RunHistory(object):
+	"""Every operation run and the commands it ran, kept in SQLite
+	
+	Run and command rows hold only metadata; command output is zlib
+	compressed in its own table so that listing runs never reads it. Runs
+	are listed newest first by id, which lets a page start after the last id
+	of the previous one instead of using OFFSET.
+	"""
+	
+	schema = """
+		CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, site TEXT, op TEXT, start_time REAL,
+			duration REAL, exit_code INTEGER, status TEXT, cmd_count INTEGER);
+		CREATE INDEX IF NOT EXISTS runs_site ON runs (site, id);
+		CREATE INDEX IF NOT EXISTS runs_op ON runs (op, id);
+		CREATE INDEX IF NOT EXISTS runs_status ON runs (status, id);
+		CREATE INDEX IF NOT EXISTS runs_start ON runs (start_time);
+		CREATE TABLE IF NOT EXISTS commands (id INTEGER PRIMARY KEY, run_id INTEGER, seq INTEGER, op TEXT, cmd TEXT,
+			start_time REAL, duration REAL, exit_code INTEGER, output_bytes INTEGER, output_id INTEGER);
+		CREATE INDEX IF NOT EXISTS commands_run ON commands (run_id, seq);
+		CREATE TABLE IF NOT EXISTS outputs (id INTEGER PRIMARY KEY, data BLOB);
+	"""
+	
+	def __init__(self, path=None):
+		if path is None:
+			path = (get_config().get('HISTORY') or {}).get('PATH') or os.path.join(os.path.expanduser('~'), '.cache', 'drupalsites', 'history.sqlite')
+		self.path = path
+		self.enabled = True
+		# Set once a failure to record a run has been reported
+		self.warned = False
+		self.local = threading.local()
+	
+	def connection(self):
+		# sqlite3 connections can't be shared between threads
+		connection = getattr(self.local, 'connection', None)
+		if connection is None:
+			os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+			connection = sqlite3.connect(self.path, timeout=30)
+			connection.row_factory = sqlite3.Row
+			connection.execute('PRAGMA journal_mode=WAL')
+			connection.executescript(self.schema)
+			self.local.connection = connection
+		return connection
+	
+	def record_run(self, site_name, op_name, start_time, duration, exit_code, status, cmd_records):
+		"""Store a run and its commands; returns the run id"""
+		if not self.enabled:
+			return None
+		connection = self.connection()
+		with connection:
+			run_id = connection.execute('INSERT INTO runs (site, op, start_time, duration, exit_code, status, cmd_count)'
+				' VALUES (?, ?, ?, ?, ?, ?, ?)', (site_name, op_name, start_time, duration, exit_code, status, len(cmd_records))).lastrowid
+			for (seq, record) in enumerate(cmd_records):
+				output_id = None
+				if record['output']:
+					output_id = connection.execute('INSERT INTO outputs (data) VALUES (?)',
+						(zlib.compress(record['output'].encode('utf-8')),)).lastrowid
+				connection.execute('INSERT INTO commands (run_id, seq, op, cmd, start_time, duration, exit_code, output_bytes, output_id)'
+					' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', (run_id, seq, record['op'], record['cmd'], record['start'],
+					record['wall'], record['exit_code'], record['output_bytes'], output_id))
+		return run_id
+	
+	def runs(self, site=None, op=None, status=None, before=None, limit=50):
+		"""Newest runs first, optionally filtered; before is the last id of the previous page"""
+		conditions = []
+		params = []
+		for (column, value) in (('site', site), ('op', op), ('status', status)):
+			if value is not None:
+				conditions.append('{} = ?'.format(column))
+				params.append(value)
+		if before is not None:
+			conditions.append('id < ?')
+			params.append(before)
+		query = 'SELECT * FROM runs'
+		if len(conditions) > 0:
+			query += ' WHERE ' + ' AND '.join(conditions)
+		query += ' ORDER BY id DESC LIMIT ?'
+		params.append(limit)
+		return [dict(row) for row in self.connection().execute(query, params)]
+	
+	def run(self, run_id, with_output=True):
+		"""A run with its commands, or None"""
+		connection = self.connection()
+		row = connection.execute('SELECT * FROM runs WHERE id = ?', (run_id,)).fetchone()
+		if row is None:
+			return None
+		run = dict(row)
+		run['commands'] = []
+		for command_row in connection.execute('SELECT * FROM commands WHERE run_id = ? ORDER BY seq', (run_id,)):
+			command = dict(command_row)
+			output_id = command.pop('output_id')
+			if with_output:
+				command['output'] = ''
+				if output_id is not None:
+					data = connection.execute('SELECT data FROM outputs WHERE id = ?', (output_id,)).fetchone()['data']
+					command['output'] = str(zlib.decompress(data), 'utf-8', 'replace')
+			run['commands'].append(command)
+		return run
+
+history = RunHistory()
+
+class HostLimiter(object):
+	"""Limits on what may run at once on each host, from the inventory's hosts section
+	
+	slots is the most operations running on the host at once. With max_load,
+	heavy operations wait until the host's 1 minute load average is below it,
+	or until max_defer seconds have passed. Hosts without an entry are
+	unlimited. Slots are counted across threads and event loops, and given
+	out in the order they were asked for.
+	"""
+	
+	load_ttl = 30
+	
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.limits = {}
+		self.in_use = collections.Counter()
+		# (event loop, future) of the operations waiting for a slot on each host
+		self.waiters = collections.defaultdict(collections.deque)
+		self.loads = {}
+	
+	def configure(self, hosts):
+		with self.lock:
+			self.limits.update(hosts or {})
+	
+	def limit(self, host, key, default=None):
+		return (self.limits.get(host) or {}).get(key, default)
+	
+	def try_acquire(self, host):
+		slots = self.limit(host, 'slots')
+		with self.lock:
+			if slots is not None and (self.in_use[host] >= slots or len(self.waiters[host]) > 0):
+				return False
+			self.in_use[host] += 1
+			return True
+	
+	async def acquire(self, host, control=None):
+		"""Wait for a slot; returns the seconds waited, or None if control was cancelled or ran out of time first"""
+		start_time = time.time()
+		if self.try_acquire(host):
+			return 0.0
+		loop = asyncio.get_running_loop()
+		waiter = (loop, loop.create_future())
+		with self.lock:
+			self.waiters[host].append(waiter)
+		def wake():
+			if not waiter[1].done():
+				waiter[1].set_result(False)
+		def cancelled():
+			loop.call_soon_threadsafe(wake)
+		if control is not None:
+			control.add_cancel_callback(cancelled)
+		try:
+			if await asyncio.wait_for(waiter[1], control.remaining() if control is not None else None):
+				return time.time() - start_time
+		except asyncio.TimeoutError:
+			pass
+		except asyncio.CancelledError:
+			# Cancelled just as the slot was given to us
+			if waiter[1].done() and not waiter[1].cancelled() and waiter[1].result():
+				self.release(host)
+			raise
+		finally:
+			if control is not None:
+				control.remove_cancel_callback(cancelled)
+			with self.lock:
+				if waiter in self.waiters[host]:
+					self.waiters[host].remove(waiter)
+		return None
+	
+	def grant(self, host, future):
+		"""Give a slot handed over by release() to its waiter, or pass it on if that stopped waiting"""
+		if future.done():
+			self.release(host)
+		else:
+			future.set_result(True)
+	
+	def release(self, host):
+		with self.lock:
+			if len(self.waiters[host]) == 0:
+				self.in_use[host] -= 1
+				return
+			# The slot stays in use, now by the first waiter
+			loop, future = self.waiters[host].popleft()
+		loop.call_soon_threadsafe(self.grant, host, future)
+	
+	def cached_load(self, host):
+		with self.lock:
+			sample = self.loads.get(host)
+		if sample is not None and time.time() - sample[0] < self.load_ttl:
+			return sample[1]
+		return None
+	
+	def record_load(self, host, load):
+		with self.lock:
+			self.loads[host] = (time.time(), load)
+
+host_limiter = HostLimiter()
+
+def run_coroutine(coro):
+	"""Run a coroutine to completion from synchronous code"""
+	return asyncio.run(coro)
+
+def trace_start_msg(operation):
+	site_str = "{}: ".format(operation.site.name) if getattr(operation, 'site', None) is not None else ''
+	return "-----> {}Starting {}\n".format(site_str, operation.name)
+
+def trace_end_msg(operation):
+	site_str = "{}: ".format(operation.site.name) if getattr(operation, 'site', None) is not None else ''
+	return "<----- {}Ending {}\n".format(site_str, operation.name)
 
 def trace_op(func):
+	if asyncio.iscoroutinefunction(func):
+		@functools.wraps(func)
+		async def coroutine_wrapper(self):
+			self.control.start(self.operation_timeout())
+			self.write(trace_start_msg(self))
+			start_time = time.time()
+			try:
+				await func(self)
+			finally:
+				self.record_op_metrics(start_time)
+			self.write(trace_end_msg(self))
+		return coroutine_wrapper
+	@functools.wraps(func)
 	def func_wrapper(self):
-		site_str = ''
-		if hasattr(self, 'site'):
-			site_str = "{}: ".format(self.site.name)
-		get_operation_output().write("-----> {}Starting {}\n".format(site_str, self.name))
-		func(self)
-		get_operation_output().write("<----- {}Ending {}\n".format(site_str, self.name))
+		self.control.start(self.operation_timeout())
+		self.write(trace_start_msg(self))
+		start_time = time.time()
+		try:
+			func(self)
+		finally:
+			self.record_op_metrics(start_time)
+		self.write(trace_end_msg(self))
 	return func_wrapper
 
+# A command for an operation's remote_steps(), run in the site's ssh session
+RemoteStep = collections.namedtuple('RemoteStep', ['cmd', 'check_error', 'tty'], defaults=(True, False))
+
+def parse_batch_output(output, marker):
+	"""Split framed batch output into (text before the first step, {step index: (exit code, output)})"""
+	frame = re.compile(r'^{} (BEGIN|END) (\d+)(?: (\d+))?\r?$'.format(re.escape(marker)), re.M)
+	preamble = None
+	results = {}
+	start = 0
+	for match in frame.finditer(output):
+		if match.group(1) == 'BEGIN':
+			if preamble is None:
+				preamble = output[:match.start()]
+			start = match.end() + 1
+		else:
+			# Drop the newline the END printf adds in case the step's output didn't end with one
+			text = output[start:match.start()]
+			text = text[:-2] if text.endswith('\r\n') else text[:-1]
+			results[int(match.group(2))] = (int(match.group(3)), text)
+	return (preamble if preamble is not None else output, results)
+
 class Operation(object):
 	name = None
 	desc = None
+	# Seconds that a successful result stays in result_cache; None disables caching
+	cache_ttl = None
+	# Names of the operations that make up a composite operation. Each step
+	# depends on the one before it, which lets OperationScheduler run the steps
+	# of many sites as one graph.
+	steps = ()
+	# True for operations that change what gather_facts reports
+	invalidates_facts = False
+	# True for operations that run commands on the site's host; each takes
+	# one of the host's slots while it runs
+	uses_host = False
+	# True for operations that load the host enough to first wait for its
+	# load average to drop below the host's max_load
+	heavy = False
+	# Seconds allowed for the whole operation and for each command; None
+	# falls back to set_timeouts() and then config.yaml
+	timeout = None
+	cmd_timeout = None
 	
-	def __init__(self, site = None):
+	def __init__(self, site = None, output = None, verbose = None, control = None, streaming = None):
 		self.site = site
+		# Each operation has its own sink and verbosity so that operations in
+		# different threads or tasks don't mix their output
+		self.output = output if output is not None else get_operation_output()
+		self.verbose = verbose if verbose is not None else get_verbose()
+		# Whether command output is written as it arrives, see set_output_streaming
+		self.streaming = streaming if streaming is not None else output_streaming
 		self.cmds = []
 		self.cmd_outputs = []
+		self.cmd_output_files = []
+		# Spill files of this operation and its sub-operations, deleted when it ends
+		self.spill_files = []
+		self.returncode = 0
+		self.exit_code = 0
+		self.errors = 0
+		self.cached_age = None
+		self.refresh = False
+		self.output_bytes = 0
+		# Commands run by this operation and its sub-operations, for the run history
+		self.cmd_records = []
+		self.control = control if control is not None else OperationControl()
+		self.timed_out_processes = set()
+
+	def write(self, msg):
+		self.output.write(msg)
+
+	def site_name(self):
+		return self.site.name if self.site is not None else None
+
+	def record_op_metrics(self, start_time):
+		metrics.record('op', self.site_name(), self.name, start_time, time.time() - start_time, self.exit_code,
+			output_bytes=self.output_bytes, cmds=len(self.cmds))
+
+	def record_cmd_metrics(self, cmd, start_time, exit_code, output_bytes, remote, output=''):
+		self.output_bytes += output_bytes
+		record = metrics.record('cmd', self.site_name(), self.name, start_time, time.time() - start_time, exit_code,
+			cmd=cmd, output_bytes=output_bytes, remote=remote)
+		self.cmd_records.append(dict(record, output=output))
+
+	def run_status(self):
+		if self.cached_age is not None:
+			return 'cached'
+		if self.control.cancelled:
+			return 'cancelled'
+		if self.exit_code == 124:
+			return 'timeout'
+		return 'ok' if self.exit_code == 0 else 'failed'
+
+	async def record_history_async(self, start_time, status=None):
+		if self.site is None:
+			return
+		loop = asyncio.get_running_loop()
+		try:
+			# On a worker thread, so a slow insert doesn't hold up the event loop
+			await loop.run_in_executor(None, history.record_run, self.site.name, self.name, start_time,
+				time.time() - start_time, self.exit_code, status if status is not None else self.run_status(), self.cmd_records)
+		except (sqlite3.Error, OSError) as e:
+			# Losing the history shouldn't fail the operation, or repeat for every one
+			if not history.warned:
+				history.warned = True
+				self.write("Could not record run history (further failures are not reported): {}\n".format(e))
+
+	def operation_timeout(self):
+		return self.timeout if self.timeout is not None else get_timeouts()[0]
+
+	def command_timeout(self):
+		"""Seconds the next command may take, allowing for the operation's deadline"""
+		cmd_timeout = self.cmd_timeout if self.cmd_timeout is not None else get_timeouts()[1]
+		timeouts = [timeout for timeout in (cmd_timeout, self.control.remaining()) if timeout is not None]
+		return min(timeouts) if len(timeouts) > 0 else None
+
+	def cancel(self):
+		"""Kill this operation's running commands and skip any it would run next; safe from any thread"""
+		self.control.cancel()
+
+	def command_refused(self, cmd):
+		"""Record an error instead of running cmd if the operation was cancelled or is out of time"""
+		if self.control.cancelled:
+			reason = 'cancelled'
+		elif self.control.expired():
+			reason = 'operation timed out'
+		else:
+			return False
+		self.record_error(124 if reason != 'cancelled' else 130)
+		self.write("***ERROR*** {}, not running '{}'\n".format(reason, cmd))
+		return True
+
+	async def create_process(self, *args, **kwargs):
+		"""Start a command in its own process group, killed if it runs past command_timeout()"""
+		process = await asyncio.create_subprocess_exec(*args, start_new_session=True, **kwargs)
+		self.control.add(process)
+		timeout = self.command_timeout()
+		if timeout is not None:
+			process.timeout_handle = asyncio.get_running_loop().call_later(max(timeout, 0), self.expire_process, process)
+		else:
+			process.timeout_handle = None
+		return process
+
+	def expire_process(self, process):
+		if process.returncode is None:
+			self.timed_out_processes.add(process)
+			kill_process_group(process)
+
+	def abandon_process(self, process):
+		"""Kill a process we stopped waiting for, e.g. on Ctrl-C or task cancellation
+		
+		Commands run in their own session, so they would not get the terminal's
+		SIGINT and would outlive us otherwise.
+		"""
+		if process.timeout_handle is not None:
+			process.timeout_handle.cancel()
+		self.control.discard(process)
+		if process.returncode is None:
+			kill_process_group(process)
+
+	def release_process(self, process, cmd):
+		"""Stop watching a finished process; returns its exit code, 124 if it timed out"""
+		if process.timeout_handle is not None:
+			process.timeout_handle.cancel()
+		self.control.discard(process)
+		if process in self.timed_out_processes:
+			self.write("***ERROR*** timed out: '{}'\n".format(cmd))
+			return 124
+		if self.control.cancelled and process.returncode < 0:
+			self.write("***ERROR*** cancelled: '{}'\n".format(cmd))
+			return 130
+		return process.returncode
+
+	def cache_validator(self):
+		"""A value that must be unchanged for a cached result to be used"""
+		return None
+
+	def run(self, refresh=False):
+		"""Perform the operation, or show its cached result if that is fresh enough"""
+		run_coroutine(self.run_async(refresh))
+
+	async def run_async(self, refresh=False):
+		self.refresh = refresh
+		start_time = time.time()
+		try:
+			await self.run_or_use_cache_async(refresh)
+		except BaseException:
+			await self.record_history_async(start_time, 'error')
+			raise
+		finally:
+			self.remove_spill_files()
+		await self.record_history_async(start_time)
+
+	def remove_spill_files(self):
+		if output_spill_dir is None:
+			for file_name in self.spill_files:
+				try:
+					os.remove(file_name)
+				except OSError:
+					pass
+		self.spill_files = []
+
+	async def run_or_use_cache_async(self, refresh):
+		if self.invalidates_facts and self.site is not None:
+			fact_cache.invalidate(self.site.name)
+		if self.cache_ttl is None or self.site is None:
+			await self.do_admitted_cmd_async()
+			return
+		if not refresh:
+			entry = result_cache.get(self.site.name, self.name, self.cache_ttl, self.cache_validator())
+			if entry is not None:
+				self.cached_age = time.time() - entry['time']
+				self.exit_code = entry['exit_code']
+				self.write("[{}: cached {} result from {} ago]\n".format(self.site.name, self.name, age_str(self.cached_age)))
+				self.write(entry['output'])
+				return
+		output = self.output
+		self.output = TeeOperationOutput(output)
+		try:
+			await self.do_admitted_cmd_async()
+		finally:
+			tee_output, self.output = self.output, output
+		if self.exit_code == 0:
+			result_cache.put(self.site.name, self.name, tee_output.getvalue(), self.exit_code, self.cache_validator())
+
+	async def do_admitted_cmd_async(self):
+		"""do_cmd_async once the site's host has a free slot and, for heavy operations, isn't too busy"""
+		host = self.site.host if self.site is not None else None
+		if not self.uses_host or host in self.control.held_hosts:
+			await self.do_cmd_async()
+			return
+		# The operation's deadline includes the time spent waiting for the host
+		self.control.start(self.operation_timeout())
+		if self.heavy and host_limiter.limit(host, 'max_load') is not None:
+			if not await self.wait_for_load_async(host):
+				self.record_error(130 if self.control.cancelled else 124)
+				self.write("***ERROR*** {} while waiting for {} to be less busy\n".format(
+					'cancelled' if self.control.cancelled else 'timed out', host))
+				return
+		waited = await host_limiter.acquire(host, self.control)
+		if waited is None:
+			self.record_error(130 if self.control.cancelled else 124)
+			self.write("***ERROR*** {} while waiting for a slot on {}\n".format(
+				'cancelled' if self.control.cancelled else 'timed out', host))
+			return
+		if waited >= 1:
+			self.write("[{}: waited {} for a slot on {}]\n".format(self.site.name, age_str(waited), host))
+		self.control.held_hosts.add(host)
+		try:
+			await self.do_cmd_async()
+		finally:
+			self.control.held_hosts.discard(host)
+			host_limiter.release(host)
+
+	async def remote_load_async(self, host):
+		load = host_limiter.cached_load(host)
+		if load is None:
+			cmd_count = len(self.cmd_outputs)
+			await self.ssh_cmd_async('cat /proc/loadavg', check_error=False, print_output=False)
+			if len(self.cmd_outputs) == cmd_count:
+				# Refused, so there is no new sample
+				return None
+			try:
+				load = float(self.cmd_outputs[-1].split()[0])
+			except (IndexError, ValueError):
+				# Can't tell, so don't hold the work back
+				return None
+			host_limiter.record_load(host, load)
+		return load
+
+	async def wait_for_load_async(self, host):
+		"""Wait while host is busy; returns False if the operation was cancelled or ran out of time first"""
+		max_load = host_limiter.limit(host, 'max_load')
+		max_defer = host_limiter.limit(host, 'max_defer', 600)
+		defer_interval = host_limiter.limit(host, 'defer_interval', 30)
+		start_time = time.time()
+		while not self.control.cancelled and not self.control.expired():
+			load = await self.remote_load_async(host)
+			if load is None or load < max_load:
+				return not self.control.cancelled and not self.control.expired()
+			if time.time() - start_time >= max_defer:
+				self.write("[{}: {} is still busy (load {:.2f}), starting anyway]\n".format(self.site.name, host, load))
+				return True
+			self.write("[{}: {} is busy (load {:.2f} >= {}), waiting]\n".format(self.site.name, host, load, max_load))
+			remaining = self.control.remaining()
+			await asyncio.sleep(defer_interval if remaining is None else max(min(defer_interval, remaining), 0))
+		return False
 
-	@abc.abstractmethod
 	def do_cmd(self):
 		"""Perform a command"""
-		return
+		run_coroutine(self.do_cmd_async())
+
+	async def do_cmd_async(self):
+		"""Perform a command from a coroutine
+		
+		Built-in operations implement this; operations that only override the
+		synchronous do_cmd are run on a worker thread.
+		"""
+		if type(self).do_cmd is Operation.do_cmd:
+			raise NotImplementedError("Operation {} does not implement do_cmd".format(self.name))
+		context = contextvars.copy_context()
+		context.run(set_thread_operation_output, self.output)
+		context.run(set_thread_verbose, self.verbose)
+		await asyncio.get_running_loop().run_in_executor(None, context.run, self.do_cmd)
 	
-	def run_a_cmd(self, args, check_error = True, print_output = True, shell=False):
-		global verbose
+	def run_a_cmd(self, args, check_error = True, print_output = True, shell=False, cwd=None):
+		run_coroutine(self.run_a_cmd_async(args, check_error, print_output, shell, cwd))
+
+	async def run_a_cmd_async(self, args, check_error = True, print_output = True, shell=False, cwd=None):
 		cmd = ' '.join(args)
+		if self.command_refused(cmd):
+			return
 		self.cmds.append(cmd)
-		if verbose:
-			get_operation_output().write(cmd+'\n')
-		completed_process = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=shell)
-		cmd_output = str(completed_process.stdout, 'utf-8')
-		self.returncode = completed_process.returncode
+		if self.verbose:
+			self.write(cmd+'\n')
+		# rsync counts as remote too: its time is spent on the network
+		remote = args[0] in ('ssh', 'rsync')
+		if shell:
+			# Same as subprocess.run(args, shell=True) on POSIX
+			args = ['/bin/sh', '-c'] + list(args)
+		start_time = time.time()
+		process = await self.create_process(*args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=cwd)
+		try:
+			if self.streaming:
+				cmd_output, output_bytes = await self.read_streamed_output(process, print_output)
+			else:
+				stdout_data, _ = await process.communicate()
+				cmd_output = str(stdout_data, 'utf-8', 'replace')
+				output_bytes = len(stdout_data)
+				self.cmd_output_files.append(None)
+		except BaseException:
+			self.abandon_process(process)
+			await process.wait()
+			raise
+		self.returncode = self.release_process(process, cmd)
+		self.record_cmd_metrics(cmd, start_time, self.returncode, output_bytes, remote, cmd_output)
 		self.cmd_outputs.append(cmd_output)
+		# A killed command is a failure even where its exit code is normally ignored
+		if self.returncode != 0 and (check_error or self.returncode in (124, 130)):
+			self.record_error(self.returncode)
 		if print_output:
 			if self.returncode != 0 and check_error:
-				get_operation_output().write("***ERROR*** for '{0}'\n".format(cmd))
-			get_operation_output().write(cmd_output)
+				self.write("***ERROR*** for '{0}'\n".format(cmd))
+			if not self.streaming:
+				self.write(cmd_output)
+
+	async def read_streamed_output(self, process, print_output):
+		"""Forward output as it arrives, keeping only a bounded tail in memory
+		
+		Returns the tail and the total number of bytes; the full output goes to a
+		spill file whose name is added to cmd_output_files.
+		"""
+		decoder = codecs.getincrementaldecoder('utf-8')('replace')
+		tail = collections.deque()
+		tail_len = 0
+		output_bytes = 0
+		prefix = 'drupalsites-{}-{}-'.format(self.site.name if self.site is not None else 'none', self.name)
+		with tempfile.NamedTemporaryFile(mode='wb', dir=output_spill_dir, prefix=prefix, suffix='.log', delete=False) as spill_file:
+			self.cmd_output_files.append(spill_file.name)
+			self.spill_files.append(spill_file.name)
+			while True:
+				chunk = await process.stdout.read(8192)
+				if not chunk:
+					break
+				spill_file.write(chunk)
+				output_bytes += len(chunk)
+				if print_output:
+					self.write(decoder.decode(chunk))
+				tail.append(chunk)
+				tail_len += len(chunk)
+				while len(tail) > 1 and tail_len - len(tail[0]) >= output_tail_size:
+					tail_len -= len(tail.popleft())
+		if print_output:
+			self.write(decoder.decode(b'', final=True))
+		await process.wait()
+		tail_data = b''.join(tail)
+		return (str(tail_data[-output_tail_size:], 'utf-8', 'replace'), output_bytes)
 
 	
 	def sys_cmd(self, cmd, check_error = True, print_output = True, shell = False):
-		os.chdir(self.site.doc_root)
+		run_coroutine(self.sys_cmd_async(cmd, check_error, print_output, shell))
+
+	async def sys_cmd_async(self, cmd, check_error = True, print_output = True, shell = False):
+		# Use cwd rather than os.chdir so that sites can run in parallel
 		args = shlex.split(cmd)
-		self.run_a_cmd(args, check_error, print_output, shell)
+		await self.run_a_cmd_async(args, check_error, print_output, shell, cwd=self.site.doc_root)
 
 	def ssh_cmd(self, cmd, check_error = True, tty = False, print_output = True):
+		run_coroutine(self.ssh_cmd_async(cmd, check_error, tty, print_output))
+
+	async def ssh_cmd_async(self, cmd, check_error = True, tty = False, print_output = True):
+		args = ['ssh'] + ssh_pool.ssh_options(self.site.ssh_alias)
 		if tty:
-			args = ['ssh', '-t', self.site.ssh_alias, cmd]
+			args.append('-t')
+		args += [self.site.ssh_alias, cmd]
+		await self.run_a_cmd_async(args, check_error, print_output)
+
+	def remote_steps(self):
+		"""RemoteSteps for an operation that only runs remote commands, or None
+		
+		Operations that return steps can have them batched into one ssh session.
+		"""
+		return None
+
+	async def run_remote_steps_async(self, steps):
+		if remote_batching and len(steps) > 1:
+			await self.ssh_batch_async([(self, steps)])
 		else:
-			args = ['ssh', self.site.ssh_alias, cmd]
-		self.run_a_cmd(args, check_error, print_output)
+			for step in steps:
+				await self.ssh_cmd_async(step.cmd, step.check_error, step.tty)
+
+	async def ssh_script_async(self, steps):
+		"""Run steps as one framed remote script; returns (preamble, {step index: (exit code, output)})
+		
+		A step missing from the results didn't finish, and self.returncode is
+		the session's exit code.
+		"""
+		marker = 'drupalsites-{}'.format(uuid.uuid4().hex)
+		script = []
+		for (index, step) in enumerate(steps):
+			script.append("printf '%s\\n' '{0} BEGIN {1}'; ( {2} ) 2>&1; printf '\\n%s\\n' \"{0} END {1} $?\"".format(
+				marker, index, step.cmd))
+		args = ['ssh'] + ssh_pool.ssh_options(self.site.ssh_alias)
+		if any(step.tty for step in steps):
+			args.append('-t')
+		args += [self.site.ssh_alias, '\n'.join(script)]
+		cmd_count = len(self.cmd_outputs)
+		await self.run_a_cmd_async(args, check_error=False, print_output=False)
+		output = ''
+		if len(self.cmd_outputs) > cmd_count:
+			output = self.cmd_outputs[-1]
+			if self.cmd_output_files[-1] is not None:
+				# Streaming keeps only a tail in memory; the frames need all of it
+				with open(self.cmd_output_files[-1], 'rb') as output_file:
+					output = str(output_file.read(), 'utf-8', 'replace')
+		return parse_batch_output(output, marker)
+
+	async def ssh_batch_async(self, batches, trace=False):
+		"""Run the remote steps of one or more operations as a single remote script
+		
+		batches is a list of (operation, steps). Each step runs in its own
+		subshell between framing lines that carry its exit code, so every step
+		gets its own output, exit code and check_error handling as if it had
+		been run with ssh_cmd_async. With trace, each operation's start and end
+		lines are written as trace_op would.
+		"""
+		preamble, results = await self.ssh_script_async([step for (operation, steps) in batches for step in steps])
+		self.write(preamble)
+		batch_returncode = self.returncode if self.returncode != 0 else 1
+		index = 0
+		for (operation, steps) in batches:
+			if trace:
+				operation.write(trace_start_msg(operation))
+			for step in steps:
+				cmd = 'ssh {}{} {}'.format('-t ' if step.tty else '', self.site.ssh_alias, step.cmd)
+				if operation is not self:
+					operation.cmds.append(cmd)
+				if index in results:
+					operation.returncode, step_output = results[index]
+				else:
+					# The session ended before this step; it failed however check_error is set
+					operation.returncode, step_output = batch_returncode, ''
+					operation.record_error(batch_returncode)
+					operation.write("***ERROR*** did not run '{}'\n".format(cmd))
+				operation.cmd_outputs.append(step_output)
+				if operation.returncode != 0 and step.check_error and index in results:
+					operation.record_error(operation.returncode)
+					operation.write("***ERROR*** for '{0}'\n".format(cmd))
+				operation.write(step_output)
+				index += 1
+			if trace:
+				operation.write(trace_end_msg(operation))
+
+	def rsync_ssh_option(self):
+		"""rsync option that sends its transfer over the site's pooled ssh connection"""
+		if not ssh_pool.enabled:
+			return ''
+		return '-e {} '.format(shlex.quote(ssh_pool.rsync_shell(self.site.ssh_alias)))
+
+	def record_error(self, exit_code=1):
+		"""Count a failure that didn't come from a command's exit code"""
+		self.errors += 1
+		if self.exit_code == 0:
+			self.exit_code = exit_code
+
+	def run_sub_op(self, op_name):
+		"""Perform another operation on this site, folding its errors into ours"""
+		return run_coroutine(self.run_sub_op_async(op_name))
+
+	async def run_steps_async(self):
+		if remote_batching:
+			operations = [self.site.get_operation(step, output=self.output, verbose=self.verbose, control=self.control,
+				streaming=self.streaming) for step in self.steps]
+			batches = [(operation, operation.remote_steps()) for operation in operations]
+			if all(steps is not None for (operation, steps) in batches):
+				await self.ssh_batch_async(batches, trace=True)
+				for operation in operations:
+					self.fold_sub_op(operation)
+				return
+		for step in self.steps:
+			await self.run_sub_op_async(step)
+
+	async def run_sub_op_async(self, op_name):
+		operation = self.site.get_operation(op_name, output=self.output, verbose=self.verbose, control=self.control,
+			streaming=self.streaming)
+		await operation.do_cmd_async()
+		self.fold_sub_op(operation)
+		return operation
+
+	def fold_sub_op(self, operation):
+		if operation.invalidates_facts:
+			fact_cache.invalidate(self.site.name)
+		self.cmd_records += operation.cmd_records
+		self.spill_files += operation.spill_files
+		self.errors += operation.errors
+		if self.exit_code == 0:
+			self.exit_code = operation.exit_code
 
 class NoOperation(Operation):
 	name = 'no_operation'
 	desc = 'Does nothing'
 
-	def __init__(self, site):
-		super(NoOperation, self).__init__(site)
+	def __init__(self, site, **kwargs):
+		super(NoOperation, self).__init__(site, **kwargs)
 
 	@trace_op
-	def do_cmd(self):
-		get_operation_output().write("Can't perform")
+	async def do_cmd_async(self):
+		self.write("Can't perform")
+	
+class CertInfo(object):
+	"""What a TLS handshake with host told us about its certificate"""
 	
+	def __init__(self, host, issuer=None, subject=None, sans=(), not_before=None, not_after=None, error=None):
+		self.host = host
+		self.issuer = issuer
+		self.subject = subject
+		self.sans = list(sans)
+		self.not_before = not_before
+		self.not_after = not_after
+		self.error = error
+	
+	def days_left(self, now=None):
+		if self.not_after is None:
+			return None
+		if now is None:
+			now = datetime.datetime.now(datetime.timezone.utc)
+		return (self.not_after - now).days
+
+def cert_info_from_peercert(host, cert):
+	def name_str(name):
+		# Names are tuples of RDNs, each a tuple of (attribute, value) pairs
+		return ', '.join('{}={}'.format(key, value) for rdn in name for (key, value) in rdn)
+	def cert_time(value):
+		return datetime.datetime.fromtimestamp(ssl.cert_time_to_seconds(value), datetime.timezone.utc)
+	sans = [value for (kind, value) in cert.get('subjectAltName', ()) if kind == 'DNS']
+	return CertInfo(host, issuer=name_str(cert.get('issuer', ())), subject=name_str(cert.get('subject', ())),
+		sans=sans, not_before=cert_time(cert['notBefore']), not_after=cert_time(cert['notAfter']))
+
+async def fetch_certificate(host, port=443, timeout=10):
+	"""Do only a TLS handshake with host and return its CertInfo
+	
+	Failures, including certificates that don't verify, are reported in the
+	CertInfo's error rather than raised.
+	"""
+	if not host:
+		return CertInfo(host, error='No base domain')
+	context = ssl.create_default_context()
+	try:
+		reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port, ssl=context, server_hostname=host), timeout)
+	except ssl.SSLCertVerificationError as e:
+		return CertInfo(host, error=e.verify_message)
+	except asyncio.TimeoutError:
+		return CertInfo(host, error='Timed out after {} seconds'.format(timeout))
+	except (OSError, ssl.SSLError) as e:
+		return CertInfo(host, error=str(e))
+	try:
+		cert = writer.get_extra_info('peercert')
+	finally:
+		writer.close()
+		try:
+			await writer.wait_closed()
+		except (OSError, ssl.SSLError):
+			pass
+	return cert_info_from_peercert(host, cert)
+
+async def scan_certificates(hosts, port=443, timeout=10, concurrency=50):
+	"""Fetch the certificates of many hosts at once, returning {host: CertInfo}"""
+	semaphore = asyncio.Semaphore(concurrency)
+	async def scan_one(host):
+		async with semaphore:
+			return await fetch_certificate(host, port, timeout)
+	cert_infos = await asyncio.gather(*[scan_one(host) for host in hosts])
+	return dict(zip(hosts, cert_infos))
+
+class GatherFacts(Operation):
+	name = 'gather_facts'
+	desc = 'Collect core version, pending updates, git HEAD, disk and db size in one ssh call'
+	uses_host = True
+	
+	def __init__(self, site, **kwargs):
+		super(GatherFacts, self).__init__(site, **kwargs)
+		self.facts = None
+
+	def fact_steps(self):
+		vps_dir = self.site.vps_dir
+		return collections.OrderedDict([
+			('core_version', RemoteStep('cd {} && drush status drupal-version --format=list'.format(vps_dir))),
+			('pending_updates', RemoteStep('cd {} && drush --format=list ups'.format(vps_dir))),
+			('git_head', RemoteStep('cd {} && git rev-parse HEAD'.format(vps_dir))),
+			('disk_bytes', RemoteStep('du -sk {}'.format(vps_dir))),
+			('db_bytes', RemoteStep('cd {} && drush sql-query --extra=--skip-column-names "SELECT SUM(data_length + index_length)'
+				' FROM information_schema.tables WHERE table_schema = DATABASE()"'.format(vps_dir)))])
+
+	def parse_fact(self, fact, text):
+		lines = [line.strip() for line in text.splitlines() if line.strip() != '']
+		if fact == 'pending_updates':
+			return lines
+		if len(lines) == 0:
+			return None
+		if fact == 'disk_bytes':
+			return int(lines[-1].split()[0]) * 1024
+		if fact == 'db_bytes':
+			return int(lines[-1])
+		return lines[-1]
+
+	@trace_op
+	async def do_cmd_async(self):
+		fact_steps = self.fact_steps()
+		preamble, results = await self.ssh_script_async(list(fact_steps.values()))
+		if len(results) == 0:
+			self.record_error(self.returncode or 1)
+			self.write("***ERROR*** could not gather facts:\n" + preamble)
+			return
+		facts = {}
+		for (index, fact) in enumerate(fact_steps):
+			exit_code, text = results.get(index, (None, ''))
+			facts[fact] = None
+			if exit_code == 0:
+				try:
+					facts[fact] = self.parse_fact(fact, text)
+				except ValueError:
+					pass
+			if facts[fact] is None:
+				self.write("Couldn't get {}: {}\n".format(fact, text.strip()))
+		self.facts = facts
+		fact_cache.put(self.site.name, facts)
+		self.write(fact_summary(fact_cache.get(self.site.name)) + "\n")
+		if self.verbose:
+			self.write(json.dumps(facts, indent=2) + "\n")
+
 class RemoteCheckCert(Operation):
 	name = 'remote_cert'
 	desc = 'Remote tls cert check'
+	cache_ttl = 6 * 3600
+	timeout = 10
 	
-	def __init__(self, site):
-		super(RemoteCheckCert, self).__init__(site)
+	def __init__(self, site, **kwargs):
+		super(RemoteCheckCert, self).__init__(site, **kwargs)
+		# Set beforehand when scan_site_certificates has already fetched it
+		self.cert_info = None
 
 	@trace_op
-	def do_cmd(self):
-		cmd = 'curl -v \'https://{}\''.format(self.site.base_domain)
-		self.sys_cmd(cmd, print_output=False)
-		#print self.stderrdata
-		p = re.compile('Server certificate.*$|server certificate verification.*$', re.MULTILINE)
-		m = p.search(self.stderrdata)
-		if not m is None:
-			end_pos = m.end()
-			str2 = self.stderrdata[end_pos:]
-			p = re.compile('^>', re.MULTILINE)
-			m = p.search(str2)
-			if m is not None:
-				str3 = str2[:m.start()]
-				if get_verbose():
-					get_operation_output().write("Certificate info:\n"+str3+"\n")
-				# Find the start date, expire date, and compute how many days left
-				m = re.search(r'start date:\s+(.*)', str3)
-				if m is not None:
-					start_str = m.group(1)
-					date_formats = ["%a, %d %b %Y %H:%M:%S %Z",
-										 "%b %d %H:%M:%S %Y %Z",
-					]
-					start_time = None
-					for format in date_formats:
-						try:
-							start_time = datetime.datetime.strptime(start_str, format)
-							break
-						except ValueError:
-							pass
-					if start_time is None:
-						raise ValueError("No format matches the start time: %s" % start_str)
-					get_operation_output().write("Start date:	{:%m/%d/%Y}\n".format(start_time))
-				m = re.search(r'expire date:\s+(.*)', str3)
-				if m is not None:
-					expire_str = m.group(1)
-					expire_time = None
-					for format in date_formats:
-						try:
-							expire_time = datetime.datetime.strptime(expire_str, format)
-							break
-						except ValueError:
-							pass
-					if expire_time is None:
-							raise ValueError("No format matches the expiration time: %s" % expire_str)
-					get_operation_output().write("Expire date: {:%m/%d/%Y}\n".format(expire_time))
-					now = datetime.datetime.now()
-					to_expire = expire_time - now
-					if to_expire.days > 14:
-						msg = "Expires in {0} days\n".format(to_expire.days)
-					elif to_expire.days <= 0:
-						msg = "!!!!!!!!Expired {0} days ago\n".format(-to_expire.days)
-					else:
-						msg = "********Expires in {0} days\n".format(to_expire.days)
-					get_operation_output().write(msg)
-				#TODO: FIX
-				# datetime.datetime.strptime(s, "%a, %d %b %Y %H:%M:%S %Z")
-			else:
-				get_operation_output().write("Can't find the end\n")
+	async def do_cmd_async(self):
+		if self.cert_info is None:
+			self.cert_info = await fetch_certificate(self.site.base_domain, timeout=self.timeout)
+		self.write_cert_info(self.cert_info)
+
+	def write_cert_info(self, cert_info):
+		if cert_info.error is not None:
+			self.record_error()
+			self.write("***ERROR*** for {}: {}\n".format(cert_info.host, cert_info.error))
+			return
+		if self.verbose:
+			self.write("Certificate info:\n  subject: {}\n  issuer: {}\n  names: {}\n".format(cert_info.subject,
+				cert_info.issuer, ', '.join(cert_info.sans)))
+		self.write("Start date:	{:%m/%d/%Y}\n".format(cert_info.not_before))
+		self.write("Expire date: {:%m/%d/%Y}\n".format(cert_info.not_after))
+		days_left = cert_info.days_left()
+		if days_left > 14:
+			msg = "Expires in {0} days\n".format(days_left)
+		elif days_left <= 0:
+			msg = "!!!!!!!!Expired {0} days ago\n".format(-days_left)
 		else:
-			#server certificate verification
-			get_operation_output().write("NO MATCH")
+			msg = "********Expires in {0} days\n".format(days_left)
+		self.write(msg)
 
 class RemoteClearCache(Operation):
 	name = 'remote_cc'
 	desc = 'Remote clear cache'
+	uses_host = True
+
+	def __init__(self, site, **kwargs):
+		super(RemoteClearCache, self).__init__(site, **kwargs)
 
-	def __init__(self, site):
-		super(RemoteClearCache, self).__init__(site)
+	def remote_steps(self):
+		return [RemoteStep('cd {} && drush cc all'.format(self.site.vps_dir), tty=True)]
 
 	@trace_op
-	def do_cmd(self):
-		cmd = 'cd {} && drush cc all'.format(self.site.vps_dir)
-		self.ssh_cmd(cmd, tty=True)
+	async def do_cmd_async(self):
+		await self.run_remote_steps_async(self.remote_steps())
 
 class Remote2LocalRestore(Operation):
 	name = 'remote_to_local_restore'
 	desc = 'Snapshot remote, sync backupfiles to local, restore snapshot on local'
+	uses_host = True
+	heavy = True
+	steps = ('remote_backup', 'remote_to_local_bam_files', 'local_restore')
 
-	def __init__(self, site):
-		super(Remote2LocalRestore, self).__init__(site)
+	def __init__(self, site, **kwargs):
+		super(Remote2LocalRestore, self).__init__(site, **kwargs)
 
 	@trace_op
-	def do_cmd(self):
-		self.site.get_operation('remote_backup').do_cmd()
-		self.site.get_operation('remote_to_local_bam_files').do_cmd()
-		self.site.get_operation('local_restore').do_cmd()
+	async def do_cmd_async(self):
+		await self.run_steps_async()
+
+class Remote2LocalStreamRestore(Operation):
+	name = 'remote_to_local_stream_restore'
+	desc = 'Stream a compressed remote db dump over ssh straight into the local db, without snapshot files'
+	uses_host = True
+	heavy = True
+	# Seconds between progress lines
+	progress_interval = 5
+	
+	def __init__(self, site, **kwargs):
+		super(Remote2LocalStreamRestore, self).__init__(site, **kwargs)
+
+	def write_progress(self, compressed, uncompressed, elapsed):
+		mb = 1024.0 * 1024.0
+		self.write("{:.1f} MB received ({:.1f} MB of SQL) in {:.0f}s, {:.2f} MB/s\n".format(compressed / mb,
+			uncompressed / mb, elapsed, compressed / mb / max(elapsed, 0.001)))
+
+	@trace_op
+	async def do_cmd_async(self):
+		# pipefail so the exit status is drush's when the dump fails, not gzip's
+		remote_cmd = 'bash -o pipefail -c {}'.format(shlex.quote('cd {} && drush sql-dump | gzip -1 -c'.format(self.site.vps_dir)))
+		dump_args = ['ssh'] + ssh_pool.ssh_options(self.site.ssh_alias) + [self.site.ssh_alias, remote_cmd]
+		load_args = ['drush', '--root={}'.format(self.site.doc_root), 'sql-cli']
+		if self.command_refused(remote_cmd):
+			return
+		for args in (dump_args, load_args):
+			self.cmds.append(' '.join(args))
+			if self.verbose:
+				self.write(' '.join(args)+'\n')
+		start_time = time.time()
+		dump = await self.create_process(*dump_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		try:
+			load = await self.create_process(*load_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+				stderr=subprocess.STDOUT, cwd=self.site.doc_root)
+		except BaseException:
+			self.abandon_process(dump)
+			await dump.wait()
+			raise
+		try:
+			dump_errors = asyncio.ensure_future(dump.stderr.read())
+			load_output = asyncio.ensure_future(load.stdout.read())
+			# Decompress here rather than in a local gunzip so we can count the SQL bytes
+			decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+			compressed = 0
+			uncompressed = 0
+			start_time = last_report = time.time()
+			error = None
+			try:
+				while True:
+					chunk = await dump.stdout.read(64 * 1024)
+					if not chunk:
+						break
+					compressed += len(chunk)
+					data = decompressor.decompress(chunk)
+					uncompressed += len(data)
+					load.stdin.write(data)
+					await load.stdin.drain()
+					now = time.time()
+					if now - last_report >= self.progress_interval:
+						self.write_progress(compressed, uncompressed, now - start_time)
+						last_report = now
+				load.stdin.write(decompressor.flush())
+				await load.stdin.drain()
+			except (BrokenPipeError, ConnectionResetError):
+				error = 'local database import stopped reading'
+			except zlib.error as e:
+				error = 'bad compressed data from remote: {}'.format(e)
+			finally:
+				if error is not None and dump.returncode is None:
+					dump.kill()
+				load.stdin.close()
+			await dump.wait()
+			await load.wait()
+		except BaseException:
+			self.abandon_process(dump)
+			self.abandon_process(load)
+			await asyncio.gather(dump.wait(), load.wait())
+			raise
+		dump_returncode = self.release_process(dump, self.cmds[-2])
+		load_returncode = self.release_process(load, self.cmds[-1])
+		dump_error_text = str(await dump_errors, 'utf-8', 'replace')
+		load_output_text = str(await load_output, 'utf-8', 'replace')
+		self.cmd_outputs += [dump_error_text, load_output_text]
+		self.record_cmd_metrics(self.cmds[-2], start_time, dump_returncode, compressed, True, dump_error_text)
+		self.record_cmd_metrics(self.cmds[-1], start_time, load_returncode, len(load_output_text), False, load_output_text)
+		self.write_progress(compressed, uncompressed, time.time() - start_time)
+		if error is None:
+			if dump_returncode != 0:
+				error = 'remote dump exited with {}'.format(dump_returncode)
+			elif uncompressed == 0 or not decompressor.eof:
+				# ssh or the connection died mid-stream without a non-zero status
+				error = 'remote dump was empty or incomplete'
+			elif load_returncode != 0:
+				error = 'local import exited with {}'.format(load_returncode)
+		self.returncode = load_returncode if error is None else (dump_returncode or load_returncode or 1)
+		if error is not None:
+			self.record_error(self.returncode)
+			self.write("***ERROR*** {}\n".format(error))
+		self.write(dump_error_text)
+		self.write(load_output_text)
 
 class RemoteBackup(Operation):
 	name = 'remote_backup'
 	desc = 'Snapshot remote (snapshot.mysql.gz in manual directory)'
+	uses_host = True
+	heavy = True
 	
-	def __init__(self, site):
-		super(RemoteBackup, self).__init__(site)
+	def __init__(self, site, **kwargs):
+		super(RemoteBackup, self).__init__(site, **kwargs)
+
+	def remote_steps(self):
+		return [RemoteStep("cd {} && [ -e {}/manual/snapshot.mysql.gz ] && rm {}/manual/snapshot.mysql.gz".format(self.site.vps_dir, self.site.bam_files, self.site.bam_files),
+				check_error=False),
+			RemoteStep("cd {} && drush bam-backup db manual snapshot".format(self.site.vps_dir), tty=True)]
 
 	@trace_op
-	def do_cmd(self):
-		cmd = "cd {} && [ -e {}/manual/snapshot.mysql.gz ] && rm {}/manual/snapshot.mysql.gz".format(self.site.vps_dir, self.site.bam_files, self.site.bam_files)
-		self.ssh_cmd(cmd, check_error=False)
-		cmd = "cd {} && drush bam-backup db manual snapshot".format(self.site.vps_dir)
-		self.ssh_cmd(cmd, tty=True)
+	async def do_cmd_async(self):
+		await self.run_remote_steps_async(self.remote_steps())
 
 class Remote2LocalBamFiles(Operation):
 	name = 'remote_to_local_bam_files'
 	desc = 'Sync remote backup files to local system'
+	uses_host = True
 	
-	def __init__(self, site):
-		super(Remote2LocalBamFiles, self).__init__(site)
+	def __init__(self, site, **kwargs):
+		super(Remote2LocalBamFiles, self).__init__(site, **kwargs)
 
 	@trace_op
-	def do_cmd(self):
-		cmd = "rsync -r {}:{}/{}/ {}/{}/".format(self.site.ssh_alias, 
+	async def do_cmd_async(self):
+		cmd = "rsync -r {}{}:{}/{}/ {}/{}/".format(self.rsync_ssh_option(), self.site.ssh_alias, 
 			self.site.vps_dir, self.site.bam_files, self.site.doc_root, self.site.bam_files)
-		self.sys_cmd(cmd)
+		await self.sys_cmd_async(cmd)
 
 class Remote2LocalDefaultFiles(Operation):
 	name = 'remote_to_local_rsync'
 	desc = 'Sync remote default/files to local system'
+	uses_host = True
 	
-	def __init__(self, site):
-		super(Remote2LocalDefaultFiles, self).__init__(site)
+	def __init__(self, site, **kwargs):
+		super(Remote2LocalDefaultFiles, self).__init__(site, **kwargs)
 
 	@trace_op
-	def do_cmd(self):
-		cmd = "rsync -avh --delete --exclude=css/ --exclude=js/ --exclude=ctool/ {}:{}/sites/default/files/ {}/sites/default/files/".format(self.site.ssh_alias, 
+	async def do_cmd_async(self):
+		cmd = "rsync -avh --delete --exclude=css/ --exclude=js/ --exclude=ctool/ {}{}:{}/sites/default/files/ {}/sites/default/files/".format(self.rsync_ssh_option(), self.site.ssh_alias, 
 			self.site.vps_dir, self.site.doc_root)
-		self.sys_cmd(cmd)
-		self.site.get_operation('local_fix_perms').do_cmd()
+		await self.sys_cmd_async(cmd)
+		await self.run_sub_op_async('local_fix_perms')
+
+class PermsScan(object):
+	
+	def __init__(self):
+		self.inspected = 0
+		self.wrong_mode = []
+		self.wrong_owner = []
+		# (path, error) of directories that couldn't be read, so weren't checked
+		self.errors = []
+
+class PermsFixer(object):
+	"""Brings a tree in line with a permissions policy, changing only what differs
+	
+	The policy is that every entry is group writable and owned by uid:gid (either
+	may be None to leave it alone). Directories are scanned in parallel with
+	os.scandir. Symbolic links are neither followed nor changed.
+	"""
+	
+	def __init__(self, uid=None, gid=None, workers=8):
+		self.uid = uid
+		self.gid = gid
+		self.workers = workers
+	
+	def check(self, path, st, scan):
+		scan.inspected += 1
+		if not st.st_mode & stat.S_IWGRP:
+			scan.wrong_mode.append((path, st.st_mode))
+		if (self.uid is not None and st.st_uid != self.uid) or (self.gid is not None and st.st_gid != self.gid):
+			scan.wrong_owner.append(path)
+	
+	def scan_dir(self, path):
+		scan = PermsScan()
+		subdirs = []
+		try:
+			with os.scandir(path) as entries:
+				for entry in entries:
+					st = entry.stat(follow_symlinks=False)
+					if stat.S_ISLNK(st.st_mode):
+						continue
+					self.check(entry.path, st, scan)
+					if stat.S_ISDIR(st.st_mode):
+						subdirs.append(entry.path)
+		except FileNotFoundError:
+			# Removed while we were scanning
+			pass
+		except OSError as e:
+			scan.errors.append((path, e.strerror or str(e)))
+		return scan, subdirs
+	
+	def scan(self, root):
+		"""Find the entries under root, and root itself, that break the policy"""
+		scan = PermsScan()
+		self.check(root, os.lstat(root), scan)
+		with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+			pending = set([executor.submit(self.scan_dir, root)])
+			while pending:
+				done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+				for future in done:
+					dir_scan, subdirs = future.result()
+					scan.inspected += dir_scan.inspected
+					scan.wrong_mode += dir_scan.wrong_mode
+					scan.wrong_owner += dir_scan.wrong_owner
+					scan.errors += dir_scan.errors
+					pending.update(executor.submit(self.scan_dir, subdir) for subdir in subdirs)
+		return scan
+	
+	def fix(self, scan):
+		"""Fix what we are allowed to; returns the paths (mode, owner) that need sudo"""
+		need_sudo_mode = []
+		need_sudo_owner = []
+		for path, mode in scan.wrong_mode:
+			try:
+				os.chmod(path, stat.S_IMODE(mode) | stat.S_IWGRP)
+			except PermissionError:
+				need_sudo_mode.append(path)
+			except FileNotFoundError:
+				pass
+		for path in scan.wrong_owner:
+			try:
+				os.chown(path, -1 if self.uid is None else self.uid, -1 if self.gid is None else self.gid, follow_symlinks=False)
+			except PermissionError:
+				need_sudo_owner.append(path)
+			except FileNotFoundError:
+				pass
+		return need_sudo_mode, need_sudo_owner
 
 class LocalFixPerms(Operation):
 	name = 'local_fix_perms'
 	desc = 'Fix local files file permissions'
+	# Paths per sudo chmod/chown command
+	sudo_batch_size = 200
 	
-	def __init__(self, site):
-		super(LocalFixPerms, self).__init__(site)
+	def __init__(self, site, **kwargs):
+		super(LocalFixPerms, self).__init__(site, **kwargs)
+
+	async def sudo_batches_async(self, args, paths):
+		"""Run args with sudo on paths in batches; returns how many paths it fixed, None if sudo wanted a password"""
+		fixed = 0
+		for start in range(0, len(paths), self.sudo_batch_size):
+			batch = paths[start:start + self.sudo_batch_size]
+			# Commands run in their own session without a terminal, so sudo could not prompt
+			await self.run_a_cmd_async(['sudo', '-n'] + args + ['--'] + batch)
+			if self.returncode == 0:
+				fixed += len(batch)
+			elif len(self.cmd_outputs) > 0 and 'password is required' in self.cmd_outputs[-1]:
+				self.write("***ERROR*** sudo needs a password: run 'sudo -v' first, or allow chmod and chown without a password in sudoers\n")
+				return None
+		return fixed
 
 	@trace_op
-	def do_cmd(self):
-		cmd = 'sudo chmod -R g+w {}'.format(self.site.doc_root)
-		self.sys_cmd(cmd)
-		cmd = 'sudo chown -R mgering:www-data {}'.format(self.site.doc_root)
-		self.sys_cmd(cmd)
+	async def do_cmd_async(self):
+		try:
+			uid = None if self.site.file_owner is None else pwd.getpwnam(self.site.file_owner).pw_uid
+			gid = None if self.site.file_group is None else grp.getgrnam(self.site.file_group).gr_gid
+		except KeyError as e:
+			self.record_error()
+			self.write("***ERROR*** {}\n".format(e.args[0]))
+			return
+		fixer = PermsFixer(uid, gid)
+		loop = asyncio.get_running_loop()
+		scan = await loop.run_in_executor(None, fixer.scan, self.site.doc_root)
+		for (path, error) in scan.errors:
+			self.record_error()
+			self.write("***ERROR*** couldn't check {}: {}\n".format(path, error))
+		need_sudo_mode, need_sudo_owner = await loop.run_in_executor(None, fixer.fix, scan)
+		# chown takes user, user:group or :group
+		owner = self.site.file_owner or ''
+		if self.site.file_group is not None:
+			owner += ':' + self.site.file_group
+		fixed_mode = len(scan.wrong_mode) - len(need_sudo_mode)
+		fixed_owner = len(scan.wrong_owner) - len(need_sudo_owner)
+		sudo_fixed = await self.sudo_batches_async(['chmod', 'g+w'], need_sudo_mode)
+		fixed_mode += sudo_fixed or 0
+		if sudo_fixed is not None:
+			fixed_owner += await self.sudo_batches_async(['chown', '-h', owner], need_sudo_owner) or 0
+		self.write("Inspected {} entries, fixed mode on {} of {} and owner on {} of {}\n".format(scan.inspected,
+			fixed_mode, len(scan.wrong_mode), fixed_owner, len(scan.wrong_owner)))
 
 class LocalRestore(Operation):
 	name = 'local_restore'
 	desc = 'Restore db from snapshot in manual backup directory'
 	
-	def __init__(self, site):
-		super(LocalRestore, self).__init__(site)
+	def __init__(self, site, **kwargs):
+		super(LocalRestore, self).__init__(site, **kwargs)
 
 	@trace_op
-	def do_cmd(self):
+	async def do_cmd_async(self):
 		cmd = 'drush --root={} --yes bam-restore db manual snapshot.mysql.gz'.format(self.site.doc_root)
-		self.sys_cmd(cmd)
+		await self.sys_cmd_async(cmd)
 
 class RemotePull(Operation):
 	name = 'remote_pull'
 	desc = 'Do git pull on remote system'
+	uses_host = True
+	invalidates_facts = True
 	
-	def __init__(self, site):
-		super(RemotePull, self).__init__(site)
+	def __init__(self, site, **kwargs):
+		super(RemotePull, self).__init__(site, **kwargs)
+
+	def remote_steps(self):
+		return [RemoteStep('cd {} && git pull'.format(self.site.vps_dir))]
 
 	@trace_op
-	def do_cmd(self):
-		self.ssh_cmd('cd {} && git pull'.format(self.site.vps_dir))
+	async def do_cmd_async(self):
+		await self.run_remote_steps_async(self.remote_steps())
 
 class RemoteUpdates(Operation):
 	name = 'remote_updates'
 	desc = 'Backup remote, remote git pull, remote drush updatedb'
+	uses_host = True
+	heavy = True
+	steps = ('remote_backup', 'remote_pull', 'remote_update_db')
 	
-	def __init__(self, site):
-		super(RemoteUpdates, self).__init__(site)
+	def __init__(self, site, **kwargs):
+		super(RemoteUpdates, self).__init__(site, **kwargs)
 
 	@trace_op
-	def do_cmd(self):
-		self.site.get_operation('remote_backup').do_cmd()
-		self.site.get_operation('remote_pull').do_cmd()		
-		self.site.get_operation('remote_update_db').do_cmd()		
+	async def do_cmd_async(self):
+		await self.run_steps_async()
 
 class RemoteUpdateDB(Operation):
 	name = 'remote_update_db'
 	desc = 'Remote drush updatedb'
+	uses_host = True
+	heavy = True
+	invalidates_facts = True
 	
-	def __init__(self, site):
-		super(RemoteUpdateDB, self).__init__(site)
+	def __init__(self, site, **kwargs):
+		super(RemoteUpdateDB, self).__init__(site, **kwargs)
+
+	def remote_steps(self):
+		return [RemoteStep("cd {} && drush --yes updatedb".format(self.site.vps_dir))]
 
 	@trace_op
-	def do_cmd(self):
-		self.ssh_cmd("cd {} && drush --yes updatedb".format(self.site.vps_dir))
+	async def do_cmd_async(self):
+		await self.run_remote_steps_async(self.remote_steps())
 
 class LocalUpdates(Operation):
 	name = 'local_updates'
 	desc = 'Pull from master, update modules & db, commit and push to master'
 	
-	def __init__(self, site):
-		super(LocalUpdates, self).__init__(site)
+	def __init__(self, site, **kwargs):
+		super(LocalUpdates, self).__init__(site, **kwargs)
+		# Files seeded into drush's download cache, removed once drush up is done
+		self.seeded_files = []
+
+	async def prefetch_releases_async(self):
+		"""Make sure the pending releases are in the shared cache and seeded into drush's download cache"""
+		await self.sys_cmd_async('drush --root={} pm-updatestatus --format=csv --fields=name,candidate_version'.format(self.site.doc_root),
+			check_error=False, print_output=False)
+		if self.returncode != 0:
+			return
+		loop = asyncio.get_running_loop()
+		for line in self.cmd_outputs[-1].splitlines():
+			fields = line.strip().split(',')
+			if len(fields) != 2 or fields[1] == '' or fields[0] == 'name':
+				continue
+			(project, version) = fields
+			try:
+				path, downloaded = await loop.run_in_executor(None, release_cache.fetch, project, version)
+				self.seeded_files.append(release_cache.seed_drush_cache(project, version, path))
+			except (OSError, ValueError, http.client.HTTPException) as e:
+				# drush will download it itself
+				self.write("Couldn't prefetch {} {}: {}\n".format(project, version, e))
+				continue
+			if self.verbose:
+				self.write("{} {} {}\n".format(project, version, 'downloaded to the release cache' if downloaded else 'from the release cache'))
 
 	@trace_op
-	def do_cmd(self):
-		self.sys_cmd('git pull'.format(self.site.doc_root))
-		self.sys_cmd('drush --root={} --yes up'.format(self.site.doc_root), check_error=False)
-		self.site.get_operation('local_update_db').do_cmd()		
-		self.sys_cmd('git checkout .gitignore .htaccess'.format(self.site.doc_root))
-		self.sys_cmd('git add *'.format(self.site.doc_root))
-		self.sys_cmd('git commit -a -m "updates"'.format(self.site.doc_root), check_error=False)
-		self.sys_cmd('git push'.format(self.site.doc_root))
+	async def do_cmd_async(self):
+		await self.sys_cmd_async('git pull'.format(self.site.doc_root))
+		try:
+			await self.prefetch_releases_async()
+			await self.sys_cmd_async('drush --root={} --yes up --cache'.format(self.site.doc_root), check_error=False)
+		finally:
+			for seeded_file in self.seeded_files:
+				release_cache.unseed_drush_cache(seeded_file)
+			self.seeded_files = []
+		await self.run_sub_op_async('local_update_db')
+		await self.sys_cmd_async('git checkout .gitignore .htaccess'.format(self.site.doc_root))
+		await self.sys_cmd_async('git add *'.format(self.site.doc_root))
+		await self.sys_cmd_async('git commit -a -m "updates"'.format(self.site.doc_root), check_error=False)
+		await self.sys_cmd_async('git push'.format(self.site.doc_root))
 
 class LocalUpdateDB(Operation):
 	name = 'local_update_db'
 	desc = 'Local drush updatedb'
 	
-	def __init__(self, site):
-		super(LocalUpdateDB, self).__init__(site)
+	def __init__(self, site, **kwargs):
+		super(LocalUpdateDB, self).__init__(site, **kwargs)
 
 	@trace_op
-	def do_cmd(self):
-		self.sys_cmd('drush --root={} --yes updatedb'.format(self.site.doc_root), check_error=False)
+	async def do_cmd_async(self):
+		await self.sys_cmd_async('drush --root={} --yes updatedb'.format(self.site.doc_root), check_error=False)
 
 class LocalUpdateStatus(Operation):
 	name = 'local_update_status'
 	desc = 'Pull from master, check for updates'
+	cache_ttl = 3600
+	# Seconds that a drush ups result is trusted when nothing was pulled.
+	# drush asks the release feed itself and can't make a conditional request,
+	# so a release published within feed_ttl of the last check is missed until
+	# it expires; this is a deliberate trade for not running ups every time.
+	feed_ttl = 6 * 3600
 	
-	def __init__(self, site):
-		super(LocalUpdateStatus, self).__init__(site)
+	def __init__(self, site, **kwargs):
+		super(LocalUpdateStatus, self).__init__(site, **kwargs)
+
+	def cache_validator(self):
+		# A commit or pull in the site makes the cached status stale
+		return git_head(self.site.doc_root)
+
+	async def upstream_head_async(self):
+		"""Commit id of the checked out branch on origin, from git ls-remote, or None"""
+		branch_ref = git_branch_ref(self.site.doc_root)
+		if branch_ref is None:
+			return None
+		await self.sys_cmd_async('git ls-remote origin {}'.format(branch_ref), check_error=False, print_output=False)
+		if self.returncode != 0:
+			return None
+		for line in self.cmd_outputs[-1].splitlines():
+			parts = line.split()
+			if len(parts) == 2 and parts[1] == branch_ref:
+				return parts[0]
+		return None
 
 	@trace_op
-	def do_cmd(self):
-		self.sys_cmd('git pull'.format(self.site.doc_root), print_output=False)
-		if self.cmd_outputs[-1].find("Already up-to-date.") < 0:
-			get_operation_output().write("git pulled:\n"+self.cmd_outputs[-1])
-		self.sys_cmd('drush --root={} --format=list ups'.format(self.site.doc_root), check_error=False, print_output=False)
+	async def do_cmd_async(self):
+		feed_ttl = (get_config().get('UPDATE_STATUS') or {}).get('FEED_TTL', self.feed_ttl)
+		state = update_state_cache.get(self.site.name)
+		upstream_head = await self.upstream_head_async()
+		local_head = git_head(self.site.doc_root)
+		# Nothing to pull and the last ups is younger than feed_ttl: reuse its answer
+		if (not self.refresh and state is not None and upstream_head is not None
+				and state['facts']['upstream_head'] == upstream_head and state['facts']['local_head'] == local_head
+				and time.time() - state['time'] < feed_ttl):
+			self.write("[{}: unchanged upstream since {} ago]\n".format(self.site.name, age_str(time.time() - state['time'])))
+			self.write(state['facts']['status'])
+			return
+		if upstream_head is None or upstream_head != local_head:
+			await self.sys_cmd_async('git pull'.format(self.site.doc_root), print_output=False)
+			if self.cmd_outputs[-1].find("Already up-to-date.") < 0:
+				self.write("git pulled:\n"+self.cmd_outputs[-1])
+		await self.sys_cmd_async('drush --root={} --format=list ups'.format(self.site.doc_root), check_error=False, print_output=False)
 		modules_to_update = self.cmd_outputs[-1].split("\n")
 		if len(modules_to_update) > 1: # Note that the last module has a newline
 			modules_to_update.pop()
-			get_operation_output().write("****** {} modules need updating: {}\n".format(len(modules_to_update), ", ".join(modules_to_update)))
+			status = "****** {} modules need updating: {}\n".format(len(modules_to_update), ", ".join(modules_to_update))
 		else:
-			get_operation_output().write("modules are up-to-date\n")
+			status = "modules are up-to-date\n"
+		self.write(status)
+		if self.errors == 0 and upstream_head is not None:
+			update_state_cache.put(self.site.name, {'upstream_head': upstream_head,
+				'local_head': git_head(self.site.doc_root), 'status': status})
 
 class OperationOutput(object):
 	
 	def write(self, msg):
 		sys.stdout.write(msg)
+
+class BufferedOperationOutput(OperationOutput):
+	
+	def __init__(self):
+		super(BufferedOperationOutput, self).__init__()
+		self.chunks = []
+	
+	def write(self, msg):
+		self.chunks.append(msg)
+	
+	def getvalue(self):
+		return ''.join(self.chunks)
+
+class TeeOperationOutput(BufferedOperationOutput):
+	"""Passes output through to another output while keeping a copy"""
+	
+	def __init__(self, output):
+		super(TeeOperationOutput, self).__init__()
+		self.output = output
+	
+	def write(self, msg):
+		super(TeeOperationOutput, self).write(msg)
+		self.output.write(msg)
 	
 OperationClasses = [RemoteClearCache,
+	GatherFacts,
 	Remote2LocalRestore,
+	Remote2LocalStreamRestore,
 	RemoteBackup,
 	Remote2LocalBamFiles,
 	Remote2LocalDefaultFiles,
@@ -370,35 +2154,368 @@ OperationClasses = [RemoteClearCache,
 	RemoteCheckCert
 ]
 
-def base_operations():
-	result = {}
-	for operation in OperationClasses:
-		result[operation.name] = operation
-	return result
+OperationInfo = collections.namedtuple('OperationInfo', ['name', 'desc', 'steps', 'source'])
+
+def literal_class_attrs(class_node):
+	attrs = {}
+	for node in class_node.body:
+		if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+			try:
+				attrs[node.targets[0].id] = ast.literal_eval(node.value)
+			except ValueError:
+				pass
+	return attrs
+
+def scan_operation_source(path):
+	"""OperationInfo for each class in a plugin file with literal name and desc, without importing it"""
+	with open(path) as source_file:
+		tree = ast.parse(source_file.read(), path)
+	infos = []
+	for node in tree.body:
+		if isinstance(node, ast.ClassDef):
+			attrs = literal_class_attrs(node)
+			if isinstance(attrs.get('name'), str) and isinstance(attrs.get('desc'), str):
+				infos.append(OperationInfo(attrs['name'], attrs['desc'], tuple(attrs.get('steps', ())),
+					'{}:{}'.format(path, node.name)))
+	return infos
+
+class OperationRegistry(collections.abc.Mapping):
+	"""Operation classes by name, including plugins that are imported on first use
+	
+	Plugins come from the 'drupalsites.operations' entry point group (name =
+	operation name, value = module:Class) and from *.py files in the plugin
+	directories. Their names and descriptions are read from the source and
+	kept in an index file, so listing operations doesn't import any plugin.
+	"""
+	
+	entry_point_group = 'drupalsites.operations'
+	
+	def __init__(self, operation_classes, plugin_dirs=None, index_path=None):
+		self.classes = dict((operation.name, operation) for operation in operation_classes)
+		self.plugin_dirs = plugin_dirs
+		if index_path is None:
+			index_path = os.path.join(os.path.expanduser('~'), '.cache', 'drupalsites', 'operations.json')
+		self.index_path = index_path
+		self.infos = None
+		self.lock = threading.Lock()
+	
+	def default_plugin_dirs(self):
+		plugin_dirs = [os.path.join(os.path.dirname(os.path.abspath(__file__)), 'plugins')]
+		plugin_dirs.extend(get_config().get('OPERATION_PLUGINS') or [])
+		if os.environ.get('DRUPALSITES_PLUGINS'):
+			plugin_dirs.extend(os.environ['DRUPALSITES_PLUGINS'].split(os.pathsep))
+		return plugin_dirs
+	
+	def read_index(self):
+		try:
+			with open(self.index_path) as index_file:
+				return json.load(index_file)
+		except (OSError, ValueError):
+			return {}
+	
+	def write_index(self, index):
+		try:
+			os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+			with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(self.index_path), delete=False) as index_file:
+				json.dump(index, index_file)
+			os.replace(index_file.name, self.index_path)
+		except OSError:
+			# The index only saves parsing next time
+			pass
+	
+	def plugin_files(self):
+		plugin_dirs = self.plugin_dirs if self.plugin_dirs is not None else self.default_plugin_dirs()
+		for plugin_dir in plugin_dirs:
+			if os.path.isdir(plugin_dir):
+				for file_name in sorted(os.listdir(plugin_dir)):
+					if file_name.endswith('.py') and not file_name.startswith('_'):
+						yield os.path.join(plugin_dir, file_name)
+	
+	def entry_point_sources(self):
+		try:
+			entry_points = importlib.metadata.entry_points(group=self.entry_point_group)
+		except TypeError:
+			entry_points = importlib.metadata.entry_points().get(self.entry_point_group, ())
+		for entry_point in entry_points:
+			module_name, class_name = entry_point.value.split(':')
+			try:
+				spec = importlib.util.find_spec(module_name)
+			except (ImportError, ValueError):
+				spec = None
+			yield (entry_point, spec.origin if spec is not None else None, class_name)
+	
+	def scan(self, path, index, new_index):
+		"""Infos for path, reparsed only when the file has changed since it was indexed"""
+		try:
+			file_stat = os.stat(path)
+		except OSError:
+			return []
+		stamp = [file_stat.st_mtime, file_stat.st_size]
+		entry = index.get(path)
+		if entry is None or entry['stamp'] != stamp:
+			try:
+				infos = scan_operation_source(path)
+			except (OSError, SyntaxError, ValueError) as e:
+				sys.stderr.write("Skipping operation plugin {}: {}\n".format(path, e))
+				infos = []
+			entry = {'stamp': stamp, 'infos': [list(info) for info in infos]}
+		new_index[path] = entry
+		return [OperationInfo(name, desc, tuple(steps), source) for (name, desc, steps, source) in entry['infos']]
+	
+	def load_infos(self):
+		with self.lock:
+			if self.infos is not None:
+				return self.infos
+			infos = collections.OrderedDict()
+			for operation in self.classes.values():
+				infos[operation.name] = OperationInfo(operation.name, operation.desc, tuple(operation.steps), None)
+			index = self.read_index()
+			new_index = {}
+			for path in self.plugin_files():
+				for info in self.scan(path, index, new_index):
+					infos[info.name] = info
+			for (entry_point, path, class_name) in self.entry_point_sources():
+				desc = ''
+				steps = ()
+				if path is not None:
+					for info in self.scan(path, index, new_index):
+						if info.source.endswith(':' + class_name):
+							(desc, steps) = (info.desc, info.steps)
+				infos[entry_point.name] = OperationInfo(entry_point.name, desc, steps, entry_point.value)
+			if new_index != index:
+				self.write_index(new_index)
+			self.infos = infos
+			return infos
+	
+	def import_operation(self, info):
+		module_name, class_name = info.source.rsplit(':', 1)
+		# Plugins subclass drupalsites.Operation, so make sure that names this
+		# module even when it is run as a script
+		sys.modules.setdefault('drupalsites', sys.modules[__name__])
+		if module_name.endswith('.py'):
+			spec = importlib.util.spec_from_file_location(
+				'drupalsites_plugin_' + os.path.splitext(os.path.basename(module_name))[0], module_name)
+			module = importlib.util.module_from_spec(spec)
+			spec.loader.exec_module(module)
+		else:
+			module = importlib.import_module(module_name)
+		return getattr(module, class_name)
+	
+	def info(self, name):
+		return self.load_infos()[name]
+	
+	def metadata(self):
+		"""OperationInfo by name, without importing any plugin"""
+		return dict(self.load_infos())
+	
+	def register(self, operation):
+		self.classes[operation.name] = operation
+		if self.infos is not None:
+			self.infos[operation.name] = OperationInfo(operation.name, operation.desc, tuple(operation.steps), None)
+	
+	def __getitem__(self, name):
+		if name not in self.classes:
+			info = self.load_infos()[name]
+			operation = self.import_operation(info)
+			with self.lock:
+				self.classes.setdefault(name, operation)
+		return self.classes[name]
+	
+	def __contains__(self, name):
+		return name in self.load_infos()
+	
+	def __iter__(self):
+		return iter(list(self.load_infos()))
+	
+	def __len__(self):
+		return len(self.load_infos())
 
 class Site(object):
 	
-	operations = base_operations()
+	operations = OperationRegistry(OperationClasses)
 	
-	def __init__(self, name, ssh_alias, doc_root, vps_dir='www', bam_files='sites/default/files/private/backup_migrate', base_domain=''):
+	def __init__(self, name, ssh_alias, doc_root, vps_dir='www', bam_files='sites/default/files/private/backup_migrate', base_domain='',
+			file_owner=None, file_group=None, tags=(), host=None):
 		self.name = name
 		self.ssh_alias = ssh_alias
 		self.doc_root = doc_root
 		self.vps_dir = vps_dir
 		self.bam_files = bam_files
 		self.base_domain = base_domain
-		if not os.path.exists(doc_root):
-			raise Exception('Site '+name+' docroot '+doc_root+' does not exist')
+		# Owner and group for local_fix_perms; None leaves them unchanged
+		perms_config = get_config().get('PERMS') or {}
+		self.file_owner = file_owner if file_owner is not None else perms_config.get('OWNER')
+		self.file_group = file_group if file_group is not None else perms_config.get('GROUP')
+		self.tags = set(tags)
+		# Sites that share a server share its limits in the inventory's hosts section
+		self.host = host if host is not None else ssh_alias
+		self.validated = False
 	
-	def get_operation(self, op_name):
+	def facts(self, max_age=None):
+		"""What gather_facts last found for this site, or None"""
+		entry = fact_cache.get(self.name, max_age)
+		return entry['facts'] if entry is not None else None
+	
+	def fact_summary(self):
+		return fact_summary(fact_cache.get(self.name))
+	
+	def may_have_updates(self):
+		"""False only if gather_facts found no pending module updates; unknown counts as True"""
+		facts = self.facts()
+		return facts is None or facts.get('pending_updates') is None or len(facts['pending_updates']) > 0
+	
+	def validate(self):
+		# Checked when an operation targets the site, so that one missing doc
+		# root doesn't stop the others from being used
+		if not self.validated:
+			if not os.path.exists(self.doc_root):
+				raise Exception('Site '+self.name+' docroot '+self.doc_root+' does not exist')
+			self.validated = True
+	
+	def get_operation(self, op_name, output=None, verbose=None, control=None, streaming=None):
+		self.validate()
 		op_cls = Site.operations[op_name] 
-		return op_cls(self)
+		settings = {'output': output, 'verbose': verbose, 'control': control, 'streaming': streaming}
+		# Operations written as __init__(self, site) get their settings after construction
+		parameters = inspect.signature(op_cls).parameters
+		if any(parameter.kind == inspect.Parameter.VAR_KEYWORD for parameter in parameters.values()):
+			accepted = set(settings)
+		else:
+			accepted = set(settings) & set(parameters)
+		operation = op_cls(self, **dict((name, value) for (name, value) in settings.items() if name in accepted))
+		for (name, value) in settings.items():
+			if name not in accepted and value is not None:
+				setattr(operation, name, value)
+		return operation
+
+class SiteInventory(collections.abc.MutableMapping):
+	"""Sites by name, read from a YAML/JSON file or a directory of them
+	
+	The file is read on first use, and each Site is built only when it is
+	looked up.
+	"""
+	
+	site_keys = ('ssh_alias', 'doc_root', 'vps_dir', 'bam_files', 'base_domain', 'file_owner', 'file_group', 'tags', 'host')
+	
+	def __init__(self, path=None):
+		self.set_path(path)
+	
+	def set_path(self, path):
+		self.path = path
+		self.entries = None
+		self.groups = {}
+		self.sites = {}
+	
+	def read_file(self, path):
+		with open(path) as inventory_file:
+			if path.endswith('.json'):
+				return json.load(inventory_file) or {}
+			import yaml
+			return yaml.safe_load(inventory_file) or {}
+	
+	def load(self):
+		if self.entries is not None:
+			return
+		path = self.path if self.path is not None else default_inventory_path()
+		if os.path.isdir(path):
+			paths = [os.path.join(path, file_name) for file_name in sorted(os.listdir(path))
+				if os.path.splitext(file_name)[1] in ('.yaml', '.yml', '.json')]
+		else:
+			paths = [path]
+		entries = collections.OrderedDict()
+		for path in paths:
+			data = self.read_file(path)
+			entries.update(data.get('sites') or {})
+			self.groups.update(data.get('groups') or {})
+			host_limiter.configure(data.get('hosts'))
+		self.entries = entries
+	
+	def __getitem__(self, name):
+		self.load()
+		if name not in self.sites:
+			entry = self.entries[name]
+			self.sites[name] = Site(name, **dict((key, entry[key]) for key in self.site_keys if key in entry))
+		return self.sites[name]
+	
+	def __setitem__(self, name, site):
+		self.load()
+		self.entries[name] = {}
+		self.sites[name] = site
+	
+	def __delitem__(self, name):
+		self.load()
+		del self.entries[name]
+		self.sites.pop(name, None)
+	
+	def __iter__(self):
+		self.load()
+		return iter(list(self.entries))
+	
+	def __len__(self):
+		self.load()
+		return len(self.entries)
+	
+	def __contains__(self, name):
+		self.load()
+		return name in self.entries
+	
+	def tags(self):
+		self.load()
+		tags = set()
+		for entry in self.entries.values():
+			tags.update((entry or {}).get('tags') or ())
+		return tags
+	
+	def select(self, specs):
+		"""Sites for names, 'all', 'pending', 'tag:<tag>' and 'group:<group>'; returns (sites, errors)
+		
+		'pending' is the sites that may have module updates according to their
+		gathered facts, so picking them doesn't contact the hosts.
+		"""
+		self.load()
+		selected = set()
+		errors = []
+		for spec in specs:
+			if spec == 'all':
+				selected.update(self.values())
+			elif spec == 'pending':
+				selected.update(site for site in self.values() if site.may_have_updates())
+			elif spec.startswith('tag:'):
+				tag = spec[len('tag:'):]
+				tagged = [self[name] for name, entry in self.entries.items() if tag in ((entry or {}).get('tags') or ())]
+				if len(tagged) == 0:
+					errors.append("No sites tagged '{0}'".format(tag))
+				selected.update(tagged)
+			elif spec.startswith('group:'):
+				group = spec[len('group:'):]
+				if group not in self.groups:
+					errors.append("No group named '{0}'".format(group))
+					continue
+				for name in self.groups[group]:
+					if name in self.entries:
+						selected.add(self[name])
+					else:
+						errors.append("Group '{0}' has no site named '{1}'".format(group, name))
+			elif spec in self.entries:
+				selected.add(self[spec])
+			else:
+				errors.append("No site named '{0}'".format(spec))
+		return (selected, errors)
 	
 def operation_help():
 	help_txt = ''
 	help_txt += "Sites:\n"
+	max_site_len = max([len(site_name) for site_name in sites] + [0])
 	for site_name in sorted(sites.keys()):
-		help_txt += "	{}\n".format(sites[site_name].name)
+		# From the fact cache, so help never contacts the hosts
+		help_txt += "	{}{}  {}\n".format(site_name, ' ' * (max_site_len - len(site_name)),
+			fact_summary(fact_cache.get(site_name)))
+	if len(sites.groups) > 0:
+		help_txt += "\nSite groups (group:NAME):\n"
+		for group in sorted(sites.groups):
+			help_txt += "	{}: {}\n".format(group, ", ".join(sites.groups[group]))
+	if len(sites.tags()) > 0:
+		help_txt += "\nSite tags (tag:NAME):\n	{}\n".format(", ".join(sorted(sites.tags())))
 	help_txt += "\nOperations (OP):\n"
 	max_op_len = max(map(len, Site.operations.keys()))
 	t_wrapper = textwrap.TextWrapper()
@@ -406,13 +2523,412 @@ def operation_help():
 	t_wrapper.initial_indent = ' ' * 2
 	t_wrapper.subsequent_indent = ' ' * (6 + max_op_len)
 	for operation_name in sorted(Site.operations.keys()):
-		operation = Site.operations[operation_name]
+		operation = Site.operations.info(operation_name)
 		op_help = "{}{}		{}\n".format(operation.name, 
 																				' ' * (max_op_len - len(operation.name)), 
 																				operation.desc)
 		help_txt += t_wrapper.fill(op_help)+"\n"
 	return help_txt
 
+class SiteOpResult(object):
+	
+	def __init__(self, site_name, op_name, exit_code, duration, output='', skipped=False):
+		self.site_name = site_name
+		self.op_name = op_name
+		self.exit_code = exit_code
+		self.duration = duration
+		self.output = output
+		self.skipped = skipped
+
+def perform_site_op(site, op_name, buffered=False, output=None, verbose=None, refresh=False, control=None,
+		streaming=None):
+	"""Perform one operation on one site, optionally buffering its output
+	
+	Output goes to the given output object if there is one. With refresh, a
+	cached result is not used. A control lets another thread cancel it, and
+	streaming overrides set_output_streaming for this operation.
+	"""
+	if buffered:
+		output = BufferedOperationOutput()
+	elif output is None:
+		output = get_operation_output()
+	start_time = time.time()
+	try:
+		operation = site.get_operation(op_name, output=output, verbose=verbose, control=control, streaming=streaming)
+		operation.run(refresh)
+		exit_code = operation.exit_code
+	except Exception:
+		output.write("***ERROR*** {}: {}\n".format(site.name, traceback.format_exc()))
+		exit_code = -1
+	duration = time.time() - start_time
+	return SiteOpResult(site.name, op_name, exit_code, duration, output.getvalue() if buffered else '')
+
+async def perform_site_op_async(site, op_name, buffered=False, output=None, verbose=None, refresh=False, control=None,
+		streaming=None):
+	"""Coroutine version of perform_site_op"""
+	if buffered:
+		output = BufferedOperationOutput()
+	elif output is None:
+		output = get_operation_output()
+	start_time = time.time()
+	try:
+		operation = site.get_operation(op_name, output=output, verbose=verbose, control=control, streaming=streaming)
+		await operation.run_async(refresh)
+		exit_code = operation.exit_code
+	except Exception:
+		output.write("***ERROR*** {}: {}\n".format(site.name, traceback.format_exc()))
+		exit_code = -1
+	duration = time.time() - start_time
+	return SiteOpResult(site.name, op_name, exit_code, duration, output.getvalue() if buffered else '')
+
+async def run_site_ops_async(sites_to_do, op_name, jobs=1, on_result=None, verbose=None, refresh=False):
+	"""Perform an operation over several sites on one event loop
+	
+	At most jobs sites are in progress at once.
+	"""
+	results = []
+	semaphore = asyncio.Semaphore(max(jobs, 1))
+	buffered = jobs > 1
+	async def run_one(site):
+		async with semaphore:
+			return await perform_site_op_async(site, op_name, buffered, verbose=verbose, refresh=refresh)
+	tasks = [asyncio.ensure_future(run_one(site)) for site in sorted(sites_to_do, key=lambda site: site.name)]
+	for task in asyncio.as_completed(tasks):
+		result = await task
+		if on_result is not None:
+			on_result(result)
+		results.append(result)
+	return results
+
+async def scan_site_certificates(sites_to_do, on_result=None, verbose=None, refresh=False, concurrency=50):
+	"""remote_cert over many sites, with one concurrent scan of all their base domains
+	
+	Sites with a fresh cached result aren't scanned, and sites that share a
+	base domain share one handshake. Each site's result is then reported,
+	cached and recorded as remote_cert would.
+	"""
+	sites_to_do = sorted(sites_to_do, key=lambda site: site.name)
+	hosts = set(site.base_domain for site in sites_to_do if refresh or
+		result_cache.get(site.name, RemoteCheckCert.name, RemoteCheckCert.cache_ttl) is None)
+	cert_infos = await scan_certificates(sorted(host for host in hosts if host), timeout=RemoteCheckCert.timeout,
+		concurrency=concurrency)
+	results = []
+	for site in sites_to_do:
+		output = BufferedOperationOutput()
+		start_time = time.time()
+		try:
+			operation = site.get_operation(RemoteCheckCert.name, output=output, verbose=verbose)
+			operation.cert_info = cert_infos.get(site.base_domain)
+			await operation.run_async(refresh)
+			exit_code = operation.exit_code
+		except Exception:
+			output.write("***ERROR*** {}: {}\n".format(site.name, traceback.format_exc()))
+			exit_code = -1
+		result = SiteOpResult(site.name, RemoteCheckCert.name, exit_code, time.time() - start_time, output.getvalue())
+		if on_result is not None:
+			on_result(result)
+		results.append(result)
+	return results
+
+def run_site_ops(sites_to_do, op_name, jobs=1, on_result=None, verbose=None, refresh=False):
+	"""Perform an operation over several sites on a pool of at most jobs threads
+	
+	on_result is called with each SiteOpResult as soon as its site finishes, so a
+	slow site does not hold back the output of the others.
+	"""
+	results = []
+	sites_to_do = sorted(sites_to_do, key=lambda site: site.name)
+	if jobs <= 1:
+		for site in sites_to_do:
+			result = perform_site_op(site, op_name, verbose=verbose, refresh=refresh)
+			if on_result is not None:
+				on_result(result)
+			results.append(result)
+		return results
+	# Commands run in their own session and don't see the terminal's Ctrl-C, so
+	# the worker threads' operations are cancelled through their controls
+	controls = [OperationControl() for site in sites_to_do]
+	with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+		futures = [executor.submit(perform_site_op, site, op_name, True, verbose=verbose, refresh=refresh, control=control)
+			for (site, control) in zip(sites_to_do, controls)]
+		try:
+			for future in concurrent.futures.as_completed(futures):
+				result = future.result()
+				if on_result is not None:
+					on_result(result)
+				results.append(result)
+		except KeyboardInterrupt:
+			for control in controls:
+				control.cancel()
+			executor.shutdown(wait=True, cancel_futures=True)
+			raise
+	return results
+
+class ScheduledStep(object):
+	
+	def __init__(self, site, op_name, depends):
+		self.site = site
+		self.op_name = op_name
+		self.depends = list(depends)
+		self.done = asyncio.Event()
+		self.result = None
+	
+	def succeeded(self):
+		return self.result is not None and not self.result.skipped and self.result.exit_code == 0
+
+class OperationScheduler(object):
+	"""Runs operations over many sites as one dependency graph
+	
+	Composite operations are expanded into their steps. The same step on
+	different sites can run at the same time, and each site's next step starts
+	as soon as that site's previous step is done. At most jobs steps run at
+	once. A step whose dependency failed or was skipped is skipped.
+	"""
+	
+	def __init__(self, jobs=4, verbose=None, refresh=False):
+		self.jobs = jobs
+		self.verbose = verbose
+		self.refresh = refresh
+		self.scheduled_steps = []
+	
+	def add(self, site, op_name, depends=()):
+		"""Schedule op_name on site after the depends steps; returns its last step"""
+		op_cls = Site.operations[op_name]
+		if len(op_cls.steps) > 0:
+			last_steps = list(depends)
+			for step in op_cls.steps:
+				last_steps = [self.add(site, step, last_steps)]
+			return last_steps[0]
+		scheduled_step = ScheduledStep(site, op_name, depends)
+		self.scheduled_steps.append(scheduled_step)
+		return scheduled_step
+	
+	async def run_step(self, scheduled_step, semaphore, on_result):
+		for dependency in scheduled_step.depends:
+			await dependency.done.wait()
+		if all(dependency.succeeded() for dependency in scheduled_step.depends):
+			async with semaphore:
+				scheduled_step.result = await perform_site_op_async(scheduled_step.site, scheduled_step.op_name, True,
+					verbose=self.verbose, refresh=self.refresh)
+		else:
+			scheduled_step.result = SiteOpResult(scheduled_step.site.name, scheduled_step.op_name, None, 0.0, skipped=True)
+		scheduled_step.done.set()
+		if on_result is not None:
+			on_result(scheduled_step.result)
+		return scheduled_step.result
+	
+	async def run(self, on_result=None):
+		semaphore = asyncio.Semaphore(max(self.jobs, 1))
+		return await asyncio.gather(*[self.run_step(scheduled_step, semaphore, on_result)
+			for scheduled_step in self.scheduled_steps])
+
+async def run_site_ops_dag(sites_to_do, op_name, jobs=1, on_result=None, verbose=None, refresh=False):
+	scheduler = OperationScheduler(jobs, verbose, refresh)
+	for site in sorted(sites_to_do, key=lambda site: site.name):
+		scheduler.add(site, op_name)
+	return await scheduler.run(on_result)
+
+def write_site_result(result):
+	if result.skipped:
+		get_operation_output().write("===== {} ===== skipped {}\n".format(result.site_name, result.op_name))
+	elif result.output != '':
+		get_operation_output().write("===== {} =====\n{}".format(result.site_name, result.output))
+		if not result.output.endswith("\n"):
+			get_operation_output().write("\n")
+
+def results_summary(results):
+	max_site_len = max([len('Site')] + [len(result.site_name) for result in results])
+	max_op_len = max([len('Operation')] + [len(result.op_name) for result in results])
+	summary = "{}  {}  {:>4}  {:>9}\n".format('Site'.ljust(max_site_len), 'Operation'.ljust(max_op_len), 'Exit', 'Seconds')
+	for result in sorted(results, key=lambda result: result.site_name):
+		summary += "{}  {}  {:>4}  {:>9.1f}\n".format(result.site_name.ljust(max_site_len), 
+			result.op_name.ljust(max_op_len), 'skip' if result.skipped else result.exit_code, result.duration)
+	return summary
+
+class CronSchedule(object):
+	"""A five field cron expression (minute hour day-of-month month day-of-week)
+	
+	Fields take *, numbers, ranges, steps and comma lists; @hourly, @daily,
+	@nightly and @weekly are accepted too. As in cron, when both day fields
+	are restricted a day matching either one is used.
+	"""
+	
+	aliases = {'@hourly': '0 * * * *', '@daily': '0 0 * * *', '@nightly': '0 2 * * *', '@weekly': '0 0 * * 0'}
+	ranges = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+	
+	def __init__(self, expr):
+		self.expr = expr
+		fields = self.aliases.get(expr.strip(), expr).split()
+		if len(fields) != 5:
+			raise ValueError("Cron schedule '{}' doesn't have 5 fields".format(expr))
+		(self.minutes, self.hours, self.days, self.months, self.weekdays) = [
+			self.parse_field(field, low, high) for (field, (low, high)) in zip(fields, self.ranges)]
+		# 7 is another name for Sunday
+		if 7 in self.weekdays:
+			self.weekdays = self.weekdays | {0}
+		self.any_day = fields[2] == '*'
+		self.any_weekday = fields[4] == '*'
+	
+	def parse_field(self, field, low, high):
+		values = set()
+		for part in field.split(','):
+			step = 1
+			if '/' in part:
+				part, step = part.split('/')
+				step = int(step)
+			if part == '*':
+				start, end = low, high
+			elif '-' in part:
+				start, end = [int(value) for value in part.split('-')]
+			else:
+				start = end = int(part)
+			if start < low or end > high or step < 1:
+				raise ValueError("Cron field '{}' is out of range {}-{}".format(field, low, high))
+			values.update(range(start, end + 1, step))
+		return values
+	
+	def day_matches(self, when):
+		day = when.day in self.days
+		# cron counts Sunday as 0, Python as 6
+		weekday = (when.weekday() + 1) % 7 in self.weekdays
+		if self.any_day:
+			return weekday
+		if self.any_weekday:
+			return day
+		return day or weekday
+	
+	def next_after(self, when):
+		"""The first matching minute after when (a naive local datetime)"""
+		when = when.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+		limit = when + datetime.timedelta(days=5 * 366)
+		while when < limit:
+			if when.month not in self.months or not self.day_matches(when):
+				when = (when + datetime.timedelta(days=1)).replace(hour=0, minute=0)
+			elif when.hour not in self.hours:
+				when = (when + datetime.timedelta(hours=1)).replace(minute=0)
+			elif when.minute not in self.minutes:
+				when += datetime.timedelta(minutes=1)
+			else:
+				return when
+		raise ValueError("Cron schedule '{}' never matches".format(self.expr))
+
+class ScheduleEntry(object):
+	
+	def __init__(self, op_name, site_specs, cron, jitter=0, refresh=True):
+		self.op_name = op_name
+		self.site_specs = list(site_specs)
+		self.schedule = CronSchedule(cron)
+		self.jitter = jitter
+		self.refresh = refresh
+		self.next_time = None
+		self.running = None
+	
+	def plan(self, now):
+		"""Pick the next run time, spread by a random delay of up to jitter seconds"""
+		next_run = self.schedule.next_after(datetime.datetime.fromtimestamp(now))
+		self.next_time = time.mktime(next_run.timetuple()) + random.uniform(0, self.jitter)
+	
+	def __str__(self):
+		return "{} on {} at '{}'".format(self.op_name, ' '.join(self.site_specs), self.schedule.expr)
+
+def read_schedule(path=None):
+	"""ScheduleEntries from a YAML file, or from the SCHEDULE section of config.yaml
+	
+	Each entry has op, sites (a list of names, all, pending, tag:TAG or group:GROUP),
+	cron and optionally jitter (seconds) and refresh.
+	"""
+	if path is not None:
+		import yaml
+		with open(path) as schedule_file:
+			data = yaml.safe_load(schedule_file) or {}
+		entries = data.get('SCHEDULE', data) if isinstance(data, dict) else data
+	else:
+		entries = get_config().get('SCHEDULE') or []
+	schedule = []
+	for entry in entries:
+		if entry['op'] not in Site.operations:
+			raise ValueError("Scheduled operation {} is not recognized".format(entry['op']))
+		site_specs = entry.get('sites', ['all'])
+		if isinstance(site_specs, str):
+			site_specs = site_specs.split()
+		schedule.append(ScheduleEntry(entry['op'], site_specs, entry['cron'], entry.get('jitter', 0),
+			entry.get('refresh', True)))
+	return schedule
+
+class SchedulerDaemon(object):
+	"""Runs scheduled operations in this process, keeping the inventory, ssh
+	connections and caches warm between runs
+	
+	At most jobs site operations run at once over all entries. An entry that
+	is still running when it comes due again is skipped, as is a site that is
+	already running the same operation for another entry.
+	"""
+	
+	def __init__(self, schedule, jobs=4, verbose=None):
+		self.schedule = schedule
+		self.jobs = jobs
+		self.verbose = verbose
+		self.active = set()
+		self.stopping = None
+	
+	def log(self, msg):
+		get_operation_output().write("{:%Y-%m-%d %H:%M:%S} {}\n".format(datetime.datetime.now(), msg))
+	
+	async def run_site(self, entry, site, semaphore):
+		key = (site.name, entry.op_name)
+		if key in self.active:
+			self.log("Skipping {} on {}: still running".format(entry.op_name, site.name))
+			return None
+		self.active.add(key)
+		try:
+			async with semaphore:
+				result = await perform_site_op_async(site, entry.op_name, True, verbose=self.verbose, refresh=entry.refresh)
+		finally:
+			self.active.discard(key)
+		self.log("{} {} exit {} in {:.1f}s".format(site.name, entry.op_name, result.exit_code, result.duration))
+		if result.exit_code != 0:
+			get_operation_output().write(result.output)
+		return result
+	
+	async def run_entry(self, entry, semaphore):
+		sites_to_do, site_errors = sites.select(entry.site_specs)
+		for site_error in site_errors:
+			self.log("{}: {}".format(entry, site_error))
+		self.log("Starting {} ({} sites)".format(entry, len(sites_to_do)))
+		results = await asyncio.gather(*[self.run_site(entry, site, semaphore)
+			for site in sorted(sites_to_do, key=lambda site: site.name)])
+		failed = len([result for result in results if result is not None and result.exit_code != 0])
+		self.log("Finished {}: {} failed".format(entry, failed))
+	
+	def stop(self):
+		self.stopping.set()
+	
+	async def run(self):
+		self.stopping = asyncio.Event()
+		loop = asyncio.get_running_loop()
+		for signal_number in (signal.SIGINT, signal.SIGTERM):
+			loop.add_signal_handler(signal_number, self.stop)
+		semaphore = asyncio.Semaphore(max(self.jobs, 1))
+		for entry in self.schedule:
+			entry.plan(time.time())
+			self.log("Scheduled {}".format(entry))
+		while not self.stopping.is_set() and len(self.schedule) > 0:
+			entry = min(self.schedule, key=lambda entry: entry.next_time)
+			try:
+				await asyncio.wait_for(self.stopping.wait(), max(entry.next_time - time.time(), 0))
+				break
+			except asyncio.TimeoutError:
+				pass
+			if entry.running is not None and not entry.running.done():
+				self.log("Skipping {}: the previous run hasn't finished".format(entry))
+			else:
+				entry.running = asyncio.ensure_future(self.run_entry(entry, semaphore))
+			entry.plan(time.time())
+		running = [entry.running for entry in self.schedule if entry.running is not None and not entry.running.done()]
+		if len(running) > 0:
+			self.log("Waiting for {} running entries".format(len(running)))
+			await asyncio.gather(*running)
+
 sites = init_sites()
 
 def interactive():
@@ -458,22 +2974,60 @@ def interactive():
 
 set_verbose(False)
 
+class OperationHelpParser(argparse.ArgumentParser):
+	"""Builds the sites and operations epilog only when help is shown"""
+	
+	def format_help(self):
+		self.epilog = operation_help()
+		return super(OperationHelpParser, self).format_help()
+
 if __name__ == "__main__":
-	parser = argparse.ArgumentParser(description='Manage drupal sites',
-		epilog=operation_help(),
+	parser = OperationHelpParser(description='Manage drupal sites',
 		formatter_class=argparse.RawDescriptionHelpFormatter)
 	parser.add_argument('-i','--interactive', action='store_true')
 	parser.add_argument('-d','--dry-run', action='store_true')
 	parser.add_argument('-v','--verbose', action='store_true')
-	parser.add_argument('--sites', nargs='*')
+	parser.add_argument('--sites', nargs='*', help='Site names, all, pending, tag:TAG or group:GROUP')
+	parser.add_argument('--inventory', help='Site inventory file or directory (default sites.yaml)')
 	parser.add_argument('--op')
+	parser.add_argument('-j','--jobs', type=int, default=1, help='Number of sites to process in parallel')
+	parser.add_argument('--engine', choices=['thread', 'async', 'dag'], default='thread',
+		help='Run parallel sites on a thread pool, on a single asyncio event loop, or as a graph of operation steps')
+	parser.add_argument('--no-ssh-pool', action='store_true', help="Don't share ssh connections between commands")
+	parser.add_argument('--stream', action='store_true', help='Show command output as it arrives')
+	parser.add_argument('--output-tail', type=int, default=64 * 1024,
+		help='Bytes of each streamed command output to keep in memory')
+	parser.add_argument('--spill-dir', help='Keep the full output of streamed commands in this directory (otherwise deleted when the operation ends)')
+	parser.add_argument('--refresh', action='store_true', help="Don't use cached results")
+	parser.add_argument('--profile', action='store_true', help='Show where the time went, by site and step')
+	parser.add_argument('--metrics-file', help='Append timing records for each command and operation to this JSONL file')
+	parser.add_argument('--no-history', action='store_true', help="Don't record runs in the run history database")
+	parser.add_argument('--batch-remote', action='store_true',
+		help="Run an operation's remote commands as one script over a single ssh session")
+	parser.add_argument('--daemon', action='store_true',
+		help='Keep running, performing the operations in the schedule (config SCHEDULE or --schedule)')
+	parser.add_argument('--schedule', help='YAML schedule file for --daemon')
+	parser.add_argument('--timeout', type=float, help='Seconds allowed for each operation (default from config TIMEOUTS)')
+	parser.add_argument('--cmd-timeout', type=float, help='Seconds allowed for each command (default from config TIMEOUTS)')
 	errors = 0
 	try:
 		if len(sys.argv) == 1:
 			parser.print_help()
 			sys.exit(1)
 		args = parser.parse_args()
+		if args.inventory is not None:
+			sites.set_path(args.inventory)
 		set_verbose(args.verbose)
+		ssh_pool.enabled = not args.no_ssh_pool
+		set_output_streaming(args.stream, args.output_tail, args.spill_dir)
+		set_timeouts(args.timeout, args.cmd_timeout)
+		set_remote_batching(args.batch_remote)
+		history.enabled = not args.no_history
+		metrics.path = args.metrics_file
+		metrics.keep = args.profile
+		if args.daemon:
+			run_coroutine(SchedulerDaemon(read_schedule(args.schedule), jobs=args.jobs).run())
+			sys.exit(0)
 		if args.interactive:
 			(site_option, op_option) = interactive()
 		else:
@@ -482,23 +3036,32 @@ if __name__ == "__main__":
 		if not op_option in Site.operations:
 			print("Operation {0} is not recognized.".format(op_option))
 			errors += 1
-		sites_to_do = set()
-		for site_name in site_option:
-			if site_name == 'all':
-				sites_to_do = set(sites.values())
-			else:
-				if site_name in sites:
-					sites_to_do.add(sites[site_name])
-				else:
-					print("No site named '{0}'".format(site_name))
-					errors += 1
+		sites_to_do, site_errors = sites.select(site_option or [])
+		for site_error in site_errors:
+			print(site_error)
+			errors += 1
 		if errors == 0:
-			for site in sites_to_do:
-				operation = site.get_operation(op_option)
-				if args.dry_run:
-					print("Dry run for operation {} on site {}".format(operation.name, site.name))
+			if args.dry_run:
+				for site in sites_to_do:
+					print("Dry run for operation {} on site {}".format(op_option, site.name))
+			else:
+				if op_option == RemoteCheckCert.name and len(sites_to_do) > 1:
+					results = run_coroutine(scan_site_certificates(sites_to_do, on_result=write_site_result,
+						refresh=args.refresh))
+				elif args.engine == 'dag':
+					results = run_coroutine(run_site_ops_dag(sites_to_do, op_option, jobs=args.jobs,
+						on_result=write_site_result, refresh=args.refresh))
+				elif args.engine == 'async':
+					results = run_coroutine(run_site_ops_async(sites_to_do, op_option, jobs=args.jobs,
+						on_result=write_site_result, refresh=args.refresh))
 				else:
-					operation.do_cmd()
+					results = run_site_ops(sites_to_do, op_option, jobs=args.jobs, on_result=write_site_result,
+						refresh=args.refresh)
+				if len(results) > 1:
+					get_operation_output().write(results_summary(results))
+				errors += len([result for result in results if result.skipped or result.exit_code != 0])
+				if args.profile:
+					get_operation_output().write(metrics.profile())
 	finally:
 		if errors == 0:
 			get_operation_output().write("Done\n")
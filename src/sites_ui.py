@@ -8,63 +8,137 @@ Created on Jan 25, 2016
 # ptvsd.enable_attach(secret='my_secret', address = ('0.0.0.0', 3000))
 # ptvsd.wait_for_attach()
 
+import collections
+import concurrent.futures
+import html
 import sys
+import threading
+import time
+import traceback
 import drupalsites
 import PySide2.QtCore
 import PySide2.QtWidgets
 
 from qt_sites_ui import *
 
+# The dialog redraws output and site status at most this often, however
+# fast the workers write
+FRAME_INTERVAL_MS = 100
+
+class OutputCoalescer(object):
+  """Output from the worker threads, held until the dialog's next frame"""
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.chunks = []
+
+  def add(self, site_name, msg, is_html=False):
+    with self.lock:
+      self.chunks.append((site_name, msg, is_html))
+
+  def take(self):
+    with self.lock:
+      chunks, self.chunks = self.chunks, []
+    return chunks
+
 class QtOperationOutput(drupalsites.OperationOutput):
   
-  def __init__(self, widget):
+  def __init__(self, coalescer, site_name):
     super(QtOperationOutput, self).__init__()
-    self.widget = widget
+    self.coalescer = coalescer
+    self.site_name = site_name
   
   def write(self, msg):
     if msg != '':
-      self.widget.emit([msg.rstrip()])
+      self.coalescer.add(self.site_name, msg)
   
 class SitesOpWorker(PySide2.QtCore.QObject):
-  def __init__(self):
+  def __init__(self, jobs=None):
     super(SitesOpWorker, self).__init__()
     self.start.connect(self.perform)
-    self.operation_output =  QtOperationOutput(self.progress)
-    drupalsites.set_operation_output(self.operation_output)
+    if jobs is None:
+      jobs = (drupalsites.get_config().get('JOBS') or {}).get('WORKERS', 4)
+    self.jobs = jobs
+    self.output = OutputCoalescer()
+    self.lock = threading.Lock()
+    # site name -> [state, start time, end time]; read by the dialog on each frame
+    self.statuses = collections.OrderedDict()
+    self.controls = {}
+    self.stopped = False
   
-  start = PySide2.QtCore.Signal(list, str, bool, bool)
+  start = PySide2.QtCore.Signal(list, str, bool, bool, bool)
   finished = PySide2.QtCore.Signal(str)
-  progress = PySide2.QtCore.Signal(list)
+  sites_queued = PySide2.QtCore.Signal(list)
   
-  def perform(self, sites, op_name, verbose_opt, dry_run_opt):
+  def perform(self, sites, op_name, verbose_opt, dry_run_opt, refresh_opt):
     errors = 0
-    msgs = []
     if op_name == '':
-      self.progress.emit(["<span style='color: red;'><b>Please select an operation.</b></span>"])
+      self.output.add(None, "<span style='color: red;'><b>Please select an operation.</b></span>", True)
       errors += 1
     if len(sites) == 0:
-      self.progress.emit(["<span style='color: red;'><b>Please select at least one site.</b></span>"])
+      self.output.add(None, "<span style='color: red;'><b>Please select at least one site.</b></span>", True)
       errors += 1
     if errors == 0:
-      self.progress.emit(["<b>Starting...</b>"])
-      for site_name in sites:
-        result = self.perform_site_op(site_name, op_name, verbose_opt, dry_run_opt)
-        msgs = result['msgs']
-        self.progress.emit(msgs);
+      self.output.add(None, "<b>Starting...</b>", True)
+      self.stopped = False
+      with self.lock:
+        self.statuses = collections.OrderedDict((site_name, ['queued', None, None]) for site_name in sites)
+      self.sites_queued.emit(list(sites))
+      with concurrent.futures.ThreadPoolExecutor(max_workers=max(self.jobs, 1)) as executor:
+        for site_name in sites:
+          executor.submit(self.perform_site_op, site_name, op_name, verbose_opt, dry_run_opt, refresh_opt)
     self.finished.emit("<b>... Done!</b>")
     
-  def perform_site_op(self, site_name, op_name, verbose_opt, dry_run_opt):
+  def set_status(self, site_name, state):
+    with self.lock:
+      status = self.statuses.setdefault(site_name, ['queued', None, None])
+      status[0] = state
+      if state == 'running':
+        status[1] = time.time()
+      elif state != 'queued':
+        status[2] = time.time()
+
+  def site_statuses(self):
+    with self.lock:
+      return [(site_name, list(status)) for (site_name, status) in self.statuses.items()]
+
+  def perform_site_op(self, site_name, op_name, verbose_opt, dry_run_opt, refresh_opt):
     msgs = []
+    if self.stopped:
+      self.set_status(site_name, 'cancelled')
+      return {'msgs': msgs}
+    self.set_status(site_name, 'running')
     site = drupalsites.sites[site_name]
-    operation = site.get_operation(op_name)
-    drupalsites.set_verbose(verbose_opt)
-    
-    if dry_run_opt:
-      msgs.append("Dry run for operation {} on site {}".format(operation.name, site.name))
-    else:
-      operation.do_cmd()
+    control = drupalsites.OperationControl()
+    with self.lock:
+      self.controls[site_name] = control
+    output = QtOperationOutput(self.output, site_name)
+    state = 'failed'
+    try:
+      operation = site.get_operation(op_name, output=output, verbose=bool(verbose_opt), control=control, streaming=True)
+      if dry_run_opt:
+        msgs.append("Dry run for operation {} on site {}".format(operation.name, site.name))
+        output.write(msgs[-1] + "\n")
+        state = 'done'
+      else:
+        operation.run(refresh_opt)
+        state = 'done' if operation.exit_code == 0 else 'failed'
+    except Exception:
+      output.write("***ERROR*** {}: {}\n".format(site_name, traceback.format_exc()))
+    finally:
+      with self.lock:
+        del self.controls[site_name]
+      self.set_status(site_name, 'cancelled' if control.cancelled else state)
     return {'msgs': msgs}
 
+  def stop(self):
+    # Called from the GUI thread while perform() is busy in the worker thread
+    self.stopped = True
+    with self.lock:
+      controls = list(self.controls.values())
+    for control in controls:
+      control.cancel()
+
 class MyManageDialog(PySide2.QtWidgets.QDialog, Ui_ManageDialog):
   def __init__(self, parent=None):
     PySide2.QtWidgets.QDialog.__init__(self)
@@ -79,6 +153,9 @@ class MyManageDialog(PySide2.QtWidgets.QDialog, Ui_ManageDialog):
     item = PySide2.QtWidgets.QListWidgetItem(self.optionListWidget)
     self.dry_run_check = PySide2.QtWidgets.QCheckBox('dry run')
     self.optionListWidget.setItemWidget(item, self.dry_run_check)
+    item = PySide2.QtWidgets.QListWidgetItem(self.optionListWidget)
+    self.refresh_check = PySide2.QtWidgets.QCheckBox('refresh (skip cached results)')
+    self.optionListWidget.setItemWidget(item, self.refresh_check)
     
     self.allSitesCheckBox.clicked.connect(self.all_sites_clicked)
     self.site_checkboxes = []
@@ -86,16 +163,34 @@ class MyManageDialog(PySide2.QtWidgets.QDialog, Ui_ManageDialog):
       item = PySide2.QtWidgets.QListWidgetItem(self.sitesListWidget)
       check = PySide2.QtWidgets.QCheckBox(site)
       check.setObjectName(site)
+      check.setToolTip(drupalsites.sites[site].fact_summary())
       self.site_checkboxes.append(check)
       self.sitesListWidget.setItemWidget(item, check)
     self.op_radios = []
     for op in sorted(drupalsites.Site.operations):
       item = PySide2.QtWidgets.QListWidgetItem(self.opListWidget)
       radio = PySide2.QtWidgets.QRadioButton(op)
-      radio.setToolTip(drupalsites.Site.operations[op].desc)
+      radio.setToolTip(drupalsites.Site.operations.info(op).desc)
       self.op_radios.append(radio)
       self.opListWidget.setItemWidget(item, radio)
     self.buttonBox.button(PySide2.QtWidgets.QDialogButtonBox.Apply).clicked.connect(self.apply)
+    self.stop_button = self.buttonBox.addButton('Stop', PySide2.QtWidgets.QDialogButtonBox.ActionRole)
+    self.stop_button.setToolTip('Kill the running commands and skip the remaining sites')
+    self.stop_button.setEnabled(False)
+    self.stop_button.clicked.connect(self.stop)
+    
+    self.status_table = PySide2.QtWidgets.QTableWidget(0, 3, self)
+    self.status_table.setHorizontalHeaderLabels(['Site', 'Status', 'Elapsed'])
+    self.status_table.horizontalHeader().setStretchLastSection(True)
+    self.status_table.setEditTriggers(PySide2.QtWidgets.QAbstractItemView.NoEditTriggers)
+    self.gridLayout.addWidget(self.status_table, 7, 0, 1, 2)
+    self.gridLayout.addWidget(self.buttonBox, 8, 0, 1, 2)
+    self.status_rows = {}
+    self.partial_lines = {}
+    self.show_site_names = False
+    self.frame_timer = PySide2.QtCore.QTimer(self)
+    self.frame_timer.setInterval(FRAME_INTERVAL_MS)
+    self.frame_timer.timeout.connect(self.render_frame)
     
     self.site_op_thread = PySide2.QtCore.QThread()
     self.site_op_thread.start()
@@ -103,7 +198,7 @@ class MyManageDialog(PySide2.QtWidgets.QDialog, Ui_ManageDialog):
     self.worker.moveToThread(self.site_op_thread)
     self.finished.connect(self.stop_thread)
     self.worker.finished.connect(self.worker_finished)
-    self.worker.progress.connect(self.worker_progress)
+    self.worker.sites_queued.connect(self.sites_queued)
 #     self.site_op_thread.started.connect(worker.perform)
     
   def stop_thread(self):
@@ -126,18 +221,66 @@ class MyManageDialog(PySide2.QtWidgets.QDialog, Ui_ManageDialog):
         break;
     verbose_opt = self.verbose_check.checkState()
     dry_run_opt = self.dry_run_check.checkState()
+    refresh_opt = self.refresh_check.checkState()
     self.msgsTextBrowser.clear()
     apply_button = self.buttonBox.button(PySide2.QtWidgets.QDialogButtonBox.Apply)
     apply_button.setEnabled(False)
-    self.worker.start.emit(sites, op, verbose_opt, dry_run_opt)
+    self.stop_button.setEnabled(True)
+    self.status_table.setRowCount(0)
+    self.status_rows = {}
+    self.partial_lines = {}
+    self.show_site_names = len(sites) > 1
+    self.frame_timer.start()
+    self.worker.start.emit(sites, op, verbose_opt, dry_run_opt, refresh_opt)
   
-  def worker_progress(self, msgs):
-    self.msgsTextBrowser.append("\n".join(msgs))
+  def stop(self):
+    self.stop_button.setEnabled(False)
+    self.worker.stop()
+
+  def sites_queued(self, sites):
+    self.status_table.setRowCount(len(sites))
+    for (row, site_name) in enumerate(sites):
+      self.status_rows[site_name] = row
+      for (column, text) in enumerate([site_name, 'queued', '']):
+        self.status_table.setItem(row, column, PySide2.QtWidgets.QTableWidgetItem(text))
+
+  def render_frame(self, final=False):
+    """Show everything the workers wrote since the last frame in one update"""
+    lines = []
+    for (site_name, msg, is_html) in self.worker.output.take():
+      if is_html:
+        lines.append(msg)
+        continue
+      # Only whole lines are shown, so that sites running together don't split each other's lines
+      text = self.partial_lines.pop(site_name, '') + msg
+      site_lines = text.split('\n')
+      if site_lines[-1] != '':
+        self.partial_lines[site_name] = site_lines[-1]
+      for line in site_lines[:-1]:
+        prefix = '[{}] '.format(site_name) if self.show_site_names and site_name is not None else ''
+        lines.append(html.escape(prefix + line))
+    if final:
+      for (site_name, line) in self.partial_lines.items():
+        lines.append(html.escape(line))
+      self.partial_lines = {}
+    if len(lines) > 0:
+      self.msgsTextBrowser.append('<br>'.join(lines))
+    now = time.time()
+    for (site_name, (state, start_time, end_time)) in self.worker.site_statuses():
+      row = self.status_rows.get(site_name)
+      if row is None:
+        continue
+      self.status_table.item(row, 1).setText(state)
+      if start_time is not None:
+        self.status_table.item(row, 2).setText('{:.1f}s'.format((end_time or now) - start_time))
   
   def worker_finished(self, msg):
+    self.frame_timer.stop()
+    self.render_frame(final=True)
     self.msgsTextBrowser.append(msg)
     apply_button = self.buttonBox.button(PySide2.QtWidgets.QDialogButtonBox.Apply)
     apply_button.setEnabled(True)
+    self.stop_button.setEnabled(False)
 
 
 if __name__ == '__main__':
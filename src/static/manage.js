@@ -1,3 +1,5 @@
+var running_batch = null;
+
 $(document).ready(function(){
 	$('#all_sites').change(function(){
 		var is_checked = $('#all_sites').prop('checked');
@@ -9,17 +11,16 @@ function perform_ops() {
 	var op_name = "";
 	var selected = $('input[name="operation"]:checked');
     $('#ajax-msgs').removeClass('hidden').empty().append('<h2>Messages</h2><ul id="msg-list"></ul>');
+    running_batch = null;
 	if (selected.length > 0) {
-	    var site_names = $('input[name="site"]:checked').map(function(){return this.value;});
+	    var site_names = $('input[name="site"]:checked').map(function(){return this.value;}).get();
 	    op_name = selected.val();
 	    var verbose_opt = $('input[name="verbose"]')[0].checked;
 	    var dry_run_opt = $('input[name="dry-run"]')[0].checked;
-	    var ajax_tracker = {remaining_ops: site_names.length};
+	    var refresh_opt = $('input[name="refresh"]')[0].checked;
 	    if (site_names.length > 0) {
 		    $('#msg-list').append('<li id="op-status">Running...</li>')
-		    for(var s = 0; s < site_names.length; s++) {
-		    	perform_op(site_names[s], op_name, verbose_opt, dry_run_opt, ajax_tracker);
-		    }
+		    start_batch(site_names, op_name, verbose_opt, dry_run_opt, refresh_opt);
 	    } else {
 	    	$('#msg-list').append('<li id="op-status">You didn\'t select any sites</li>')
 	    }
@@ -28,21 +29,63 @@ function perform_ops() {
 	}	
 }
 
-function perform_op(site_name, op_name, verbose_opt, dry_run_opt, ajax_tracker) {
-	$.getJSON($SCRIPT_ROOT + '/site-op', {site: site_name,
-		op: op_name, verbose: verbose_opt, dry_run: dry_run_opt},
-		function(data){
-			var msgs = data['msgs'];
-			for(i = 0; i < msgs.length; i++) {
-				$('#op-status').before('<li>'+msgs[i]+'</li>');
-			}
-		}).always(function(){
-			ajax_tracker.remaining_ops--;
-			var status_text = "Still running...";
-			if(ajax_tracker.remaining_ops == 0) {
-				status_text = "Done!";
-			}
-			$('#op-status').text(status_text);				
+function start_batch(site_names, op_name, verbose_opt, dry_run_opt, refresh_opt) {
+	// One request for all the sites; the server decides how many run at once
+	var site_items = {};
+	for(var s = 0; s < site_names.length; s++) {
+		site_items[site_names[s]] = $('<li class="job-output"><code></code></li>');
+		$('#op-status').before(site_items[site_names[s]]);
+	}
+	$.ajax({url: $SCRIPT_ROOT + '/batch', type: 'POST', contentType: 'application/json',
+		dataType: 'json', data: JSON.stringify({sites: site_names, op: op_name,
+		verbose: verbose_opt, dry_run: dry_run_opt, refresh: refresh_opt})})
+		.done(function(batch){
+			running_batch = batch.id;
+			stream_batch(batch, site_items);
+		}).fail(function(){
+			$('#op-status').text("Could not start " + op_name);
 		});
 	return false;
-}
\ No newline at end of file
+}
+
+function stream_batch(batch, site_items) {
+	var source = new EventSource($SCRIPT_ROOT + '/batch/' + batch.id + '/stream');
+	var remaining_ops = batch.jobs.length;
+	source.addEventListener('output', function(e){
+		var data = JSON.parse(e.data);
+		append_output(site_items[data.site].find('code'), data.text);
+	});
+	source.addEventListener('site_done', function(e){
+		var status = JSON.parse(e.data);
+		var site_item = site_items[status.site];
+		if(status.state == 'cancelled') {
+			append_output(site_item.find('code'), "Cancelled\n");
+			site_item.addClass('job-failed');
+		} else if(status.state == 'failed') {
+			site_item.addClass('job-failed');
+		}
+		remaining_ops--;
+		$('#op-status').text("Still running... " + remaining_ops + " of " + batch.jobs.length + " sites left");
+	});
+	source.addEventListener('done', function(e){
+		source.close();
+		running_batch = null;
+		$('#op-status').text("Done!");
+	});
+}
+
+function cancel_ops() {
+	if(running_batch != null) {
+		$.post($SCRIPT_ROOT + '/batch/' + running_batch + '/cancel');
+	}
+}
+
+function append_output(code, text) {
+	var lines = text.split("\n");
+	for(var i = 0; i < lines.length; i++) {
+		if(i > 0) {
+			code.append('<br>');
+		}
+		code.append(document.createTextNode(lines[i]));
+	}
+}
@@ -4,26 +4,332 @@ Created on Jan 22, 2016
 
 @author: mgering
 '''
-import StringIO
-import cgi
-import sys
+import collections
+import concurrent.futures
+import html
+import json
+import threading
+import time
+import uuid
 import yaml
-from flask import Flask, render_template, redirect, url_for, flash, request, Markup, jsonify
-from drupalsites import Site, sites, set_verbose
-from contextlib import contextmanager
+from flask import Flask, render_template, redirect, url_for, flash, request, jsonify, abort, Response
+from markupsafe import Markup
+import drupalsites
+from drupalsites import Site, sites
 
 app = Flask(__name__)
 app.secret_key = "It's my secret"
+app.config['JOB_WORKERS'] = 4
+app.config['JOB_RETENTION'] = 3600
 
 
-@contextmanager
-def stdout_redirector(stream):
-    old_stdout = sys.stdout
-    sys.stdout = stream
-    try:
-        yield
-    finally:
-        sys.stdout = old_stdout
+class Job(object):
+  """One operation on one site, run in the background
+
+  Output is kept as a list of chunks so that any number of streams can
+  follow it from their own position.
+  """
+
+  def __init__(self, site_name, op_name, verbose_opt, dry_run_opt, refresh_opt=False, batch=None):
+    self.id = uuid.uuid4().hex
+    self.batch = batch
+    self.site_name = site_name
+    self.op_name = op_name
+    self.verbose_opt = verbose_opt
+    self.dry_run_opt = dry_run_opt
+    self.refresh_opt = refresh_opt
+    self.state = 'queued'
+    self.exit_code = None
+    self.duration = None
+    self.finished_time = None
+    self.control = drupalsites.OperationControl()
+    self.chunks = []
+    self.condition = threading.Condition()
+
+  def append(self, msg):
+    with self.condition:
+      self.chunks.append(msg)
+      self.condition.notify_all()
+    if self.batch is not None:
+      self.batch.append_event('output', {'job': self.id, 'site': self.site_name, 'text': msg})
+
+  def finish(self, state, exit_code=None, duration=None):
+    with self.condition:
+      self.state = state
+      self.exit_code = exit_code
+      self.duration = duration
+      self.finished_time = time.time()
+      self.condition.notify_all()
+    if self.batch is not None:
+      self.batch.append_event('site_done', self.status())
+
+  def is_finished(self):
+    return self.state in ('done', 'failed', 'cancelled')
+
+  def wait_for_output(self, position, timeout):
+    """Return (chunks after position, finished) once there is news or on timeout"""
+    with self.condition:
+      if len(self.chunks) <= position and not self.is_finished():
+        self.condition.wait(timeout)
+      return (self.chunks[position:], self.is_finished())
+
+  def status(self):
+    return {'id': self.id, 'site': self.site_name, 'op': self.op_name,
+      'state': self.state, 'exit_code': self.exit_code, 'duration': self.duration}
+
+class Batch(object):
+  """One operation on many sites, run as jobs on the shared job pool
+
+  Output and completion events from all of its jobs go into one event list,
+  so a single stream can follow the whole batch.
+  """
+
+  def __init__(self, op_name):
+    self.id = uuid.uuid4().hex
+    self.op_name = op_name
+    self.jobs = []
+    self.events = []
+    self.done_count = 0
+    self.condition = threading.Condition()
+
+  def append_event(self, event, data):
+    with self.condition:
+      self.events.append((event, data))
+      if event == 'site_done':
+        self.done_count += 1
+      self.condition.notify_all()
+
+  def is_finished(self):
+    # Counted from the events so the stream never ends before the last site_done
+    return self.done_count == len(self.jobs)
+
+  def finished_time(self):
+    return max(job.finished_time for job in self.jobs) if len(self.jobs) > 0 else time.time()
+
+  def wait_for_events(self, position, timeout):
+    """Return (events after position, finished) once there is news or on timeout"""
+    with self.condition:
+      if len(self.events) <= position and not self.is_finished():
+        self.condition.wait(timeout)
+      return (self.events[position:], self.is_finished())
+
+  def status(self):
+    job_statuses = [job.status() for job in self.jobs]
+    states = collections.Counter(job_status['state'] for job_status in job_statuses)
+    return {'id': self.id, 'op': self.op_name, 'finished': self.is_finished(),
+      'counts': dict(states), 'jobs': job_statuses}
+
+class JobOutput(drupalsites.OperationOutput):
+
+  def __init__(self, job):
+    super(JobOutput, self).__init__()
+    self.job = job
+
+  def write(self, msg):
+    if msg != '':
+      self.job.append(msg)
+
+jobs = {}
+batches = {}
+jobs_lock = threading.Lock()
+job_executor = None
+
+def get_job_executor():
+  global job_executor
+  with jobs_lock:
+    if job_executor is None:
+      job_executor = concurrent.futures.ThreadPoolExecutor(max_workers=app.config['JOB_WORKERS'])
+  return job_executor
+
+def prune_jobs():
+  cutoff = time.time() - app.config['JOB_RETENTION']
+  with jobs_lock:
+    for job_id, job in list(jobs.items()):
+      if job.is_finished() and job.finished_time < cutoff:
+        del jobs[job_id]
+    for batch_id, batch in list(batches.items()):
+      if batch.is_finished() and batch.finished_time() < cutoff:
+        del batches[batch_id]
+
+def run_job(job):
+  if job.control.cancelled:
+    job.finish('cancelled')
+    return
+  job.state = 'running'
+  output = JobOutput(job)
+  if job.dry_run_opt:
+    output.write("Dry run for operation {} on site {}\n".format(job.op_name, job.site_name))
+    job.finish('done', 0, 0.0)
+    return
+  # Stream so /jobs/<id>/stream shows command output as it arrives
+  result = drupalsites.perform_site_op(sites[job.site_name], job.op_name, output=output,
+    verbose=job.verbose_opt, refresh=job.refresh_opt, control=job.control, streaming=True)
+  if job.control.cancelled:
+    job.finish('cancelled', result.exit_code, result.duration)
+  else:
+    job.finish('done' if result.exit_code == 0 else 'failed', result.exit_code, result.duration)
+
+def submit_job(site_name, op_name, verbose_opt, dry_run_opt, refresh_opt=False, batch=None):
+  prune_jobs()
+  job = Job(site_name, op_name, verbose_opt, dry_run_opt, refresh_opt, batch)
+  with jobs_lock:
+    jobs[job.id] = job
+  get_job_executor().submit(run_job, job)
+  return job
+
+def submit_batch(site_names, op_name, verbose_opt, dry_run_opt, refresh_opt=False):
+  batch = Batch(op_name)
+  # Create every job before any starts so the batch can't look finished early
+  batch.jobs = [Job(site_name, op_name, verbose_opt, dry_run_opt, refresh_opt, batch) for site_name in site_names]
+  prune_jobs()
+  with jobs_lock:
+    batches[batch.id] = batch
+    for job in batch.jobs:
+      jobs[job.id] = job
+  executor = get_job_executor()
+  for job in batch.jobs:
+    executor.submit(run_job, job)
+  return batch
+
+def get_batch(batch_id):
+  with jobs_lock:
+    batch = batches.get(batch_id)
+  if batch is None:
+    abort(404)
+  return batch
+
+def get_job(job_id):
+  with jobs_lock:
+    job = jobs.get(job_id)
+  if job is None:
+    abort(404)
+  return job
+
+def sse_event(event, data, event_id=None):
+  msg = "event: {}\ndata: {}\n".format(event, json.dumps(data))
+  if event_id is not None:
+    msg += "id: {}\n".format(event_id)
+  return msg + "\n"
+
+@app.route("/jobs", methods=['POST'])
+def create_job():
+  params = request.get_json(silent=True) or request.form
+  site_name = params.get('site')
+  op_name = params.get('op')
+  if site_name not in sites or op_name not in Site.operations:
+    return jsonify({'error': "Unknown site or operation"}), 400
+  verbose_opt = params.get('verbose') in (True, 'true')
+  dry_run_opt = params.get('dry_run') in (True, 'true')
+  refresh_opt = params.get('refresh') in (True, 'true')
+  job = submit_job(site_name, op_name, verbose_opt, dry_run_opt, refresh_opt)
+  return jsonify(job.status()), 202
+
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+  return jsonify(get_job(job_id).status())
+
+@app.route("/jobs/<job_id>/cancel", methods=['POST'])
+def cancel_job(job_id):
+  job = get_job(job_id)
+  if not job.is_finished():
+    # Kills the job's running commands; a queued job finishes without starting
+    job.control.cancel()
+  return jsonify(job.status()), 202
+
+@app.route("/jobs/<job_id>/stream")
+def job_stream(job_id):
+  job = get_job(job_id)
+  # A reconnecting EventSource sends the last id it saw, so it resumes rather than repeats
+  try:
+    start_position = int(request.headers.get('Last-Event-ID', 0))
+  except ValueError:
+    start_position = 0
+  def events():
+    position = start_position
+    while True:
+      chunks, finished = job.wait_for_output(position, timeout=15)
+      if len(chunks) > 0:
+        position += len(chunks)
+        yield sse_event('output', ''.join(chunks), position)
+      elif finished:
+        yield sse_event('done', job.status())
+        return
+      else:
+        # Keeps proxies from closing an idle connection
+        yield ": keep-alive\n\n"
+  return Response(events(), mimetype='text/event-stream',
+    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route("/batch", methods=['POST'])
+def create_batch():
+  params = request.get_json(silent=True) or {}
+  site_names = params.get('sites') or []
+  op_name = params.get('op')
+  if op_name not in Site.operations:
+    return jsonify({'error': "Unknown operation"}), 400
+  unknown_sites = [site_name for site_name in site_names if site_name not in sites]
+  if len(site_names) == 0 or len(unknown_sites) > 0:
+    return jsonify({'error': "No sites or unknown sites", 'unknown_sites': unknown_sites}), 400
+  verbose_opt = params.get('verbose') in (True, 'true')
+  dry_run_opt = params.get('dry_run') in (True, 'true')
+  refresh_opt = params.get('refresh') in (True, 'true')
+  batch = submit_batch(sorted(set(site_names)), op_name, verbose_opt, dry_run_opt, refresh_opt)
+  return jsonify(batch.status()), 202
+
+@app.route("/batch/<batch_id>")
+def batch_status(batch_id):
+  return jsonify(get_batch(batch_id).status())
+
+@app.route("/batch/<batch_id>/cancel", methods=['POST'])
+def cancel_batch(batch_id):
+  batch = get_batch(batch_id)
+  for job in batch.jobs:
+    if not job.is_finished():
+      job.control.cancel()
+  return jsonify(batch.status()), 202
+
+@app.route("/batch/<batch_id>/stream")
+def batch_stream(batch_id):
+  batch = get_batch(batch_id)
+  try:
+    start_position = int(request.headers.get('Last-Event-ID', 0))
+  except ValueError:
+    start_position = 0
+  def events():
+    position = start_position
+    while True:
+      batch_events, finished = batch.wait_for_events(position, timeout=15)
+      if len(batch_events) > 0:
+        for (event, data) in batch_events:
+          position += 1
+          yield sse_event(event, data, position)
+      elif finished:
+        yield sse_event('done', batch.status())
+        return
+      else:
+        yield ": keep-alive\n\n"
+  return Response(events(), mimetype='text/event-stream',
+    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route("/history")
+def history_runs():
+  try:
+    before = int(request.args['before']) if 'before' in request.args else None
+    limit = min(int(request.args.get('limit', 50)), 500)
+  except ValueError:
+    return jsonify({'error': "before and limit must be numbers"}), 400
+  runs = drupalsites.history.runs(site=request.args.get('site'), op=request.args.get('op'),
+    status=request.args.get('status'), before=before, limit=limit)
+  # Pass next back as before to get the following page
+  next_before = runs[-1]['id'] if len(runs) == limit else None
+  return jsonify({'runs': runs, 'next': next_before})
+
+@app.route("/history/<int:run_id>")
+def history_run(run_id):
+  run = drupalsites.history.run(run_id, with_output=request.args.get('output') != 'false')
+  if run is None:
+    abort(404)
+  return jsonify(run)
 
 @app.route("/site-op")
 def site_op():
@@ -31,35 +337,33 @@ def site_op():
   op_name = request.args.get('op')
   verbose_opt = request.args.get('verbose') == 'true'
   dry_run_opt = request.args.get('dry_run') == 'true'
-  op_result = perform_site_op(site_name, op_name, verbose_opt, dry_run_opt)
+  refresh_opt = request.args.get('refresh') == 'true'
+  op_result = perform_site_op(site_name, op_name, verbose_opt, dry_run_opt, refresh_opt)
   return jsonify(op_result)
 
 @app.route("/manage")
 def manage():
   global sites
-  return render_template('manage.html', ops_dict=Site.operations, sites_dict=sites)
+  return render_template('manage.html', ops_dict=Site.operations.metadata(), sites_dict=sites)
 
-def perform_site_op(site_name, op_name, verbose_opt, dry_run_opt):
+def perform_site_op(site_name, op_name, verbose_opt, dry_run_opt, refresh_opt=False):
   msgs = []
   site = sites[site_name]
-  operation = site.get_operation(op_name)
-  set_verbose(verbose_opt)
+  output = drupalsites.BufferedOperationOutput()
+  operation = site.get_operation(op_name, output=output, verbose=verbose_opt)
   if dry_run_opt:
     msgs.append("Dry run for operation {} on site {}".format(operation.name, site.name))
   else:
-    std_str = StringIO.StringIO()
-    with stdout_redirector(std_str):
-      operation.do_cmd()
-      msg = cgi.escape(std_str.getvalue()).replace("\n", "<br>")
-      msg = Markup("<code>"+msg+"</code>")
-      msgs.append(msg)
-      std_str.close()
+    operation.run(refresh_opt)
+    msg = html.escape(output.getvalue(), quote=False).replace("\n", "<br>")
+    msg = Markup("<code>"+msg+"</code>")
+    msgs.append(msg)
   return {'msgs': msgs}
 
 if __name__ == '__main__':
   try:
-    config_file = file('config.yaml', 'r')
-    config = yaml.load(config_file)
+    config_file = open('config.yaml', 'r')
+    config = yaml.safe_load(config_file)
     if config['FLASK']['DEBUG']:
       app.debug = True
       use_debugger = True
@@ -69,7 +373,12 @@ if __name__ == '__main__':
         app.use_reloader = use_debugger
       except:
         pass
+    try:
+      app.config['JOB_WORKERS'] = config['JOBS']['WORKERS']
+      app.config['JOB_RETENTION'] = config['JOBS']['RETENTION']
+    except:
+      pass
   except:
     print("Problem openning config.yaml")
   print(app)
-  app.run(host='0.0.0.0')
\ No newline at end of file
+  app.run(host='0.0.0.0', threaded=True)